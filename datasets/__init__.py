@@ -41,9 +41,15 @@ def name2be(name):
 def get_dataset(ds, define=False):
     return name2be(ds.backend).get_dataset(ds, define=define)
 
+def get_reader(ds, **kw):
+    return name2be(ds.backend).get_reader(ds, **kw)
+
 def get_dataset_meta(ds):
     return name2be(ds.backend).get_meta(ds.ns, ds.name)
 
+def refresh_catalog(ds):
+    return name2be(ds.backend).refresh_catalog(ds.get('ns'), ds.get('name'))
+
 def drop_dataset(ds):
     return name2be(ds.backend).drop_dataset(ds)
 
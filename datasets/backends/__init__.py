@@ -23,4 +23,24 @@ class Backend(object):
             raise ValueError('Unknown backend in params: %s' % params )
 
     def process(self, data):
-        return self.backend.process_many(data)
\ No newline at end of file
+        return self.backend.process_many(data)
+
+    def process_batches(self, batches):
+        return self.backend.process_batches(batches)
+
+    def submit(self, data):
+        return self.backend.submit(data)
+
+    def close(self):
+        return self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncBackend(Backend):
+    async def process(self, data):
+        return await self.backend.aprocess_many(data)
@@ -1,22 +1,144 @@
+import asyncio
 import logging
+import multiprocessing
+import queue
+import time
+from collections import deque
+from copy import deepcopy
+from itertools import islice
 from bson import ObjectId
 from datetime import datetime
 from pprint import pformat
-from threading import Lock
+from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
 from slovar import slovar
 from slovar.strings import split_strip
 from prf.utils import typecast, str2dt
 
 import datasets
-from prf.es import ES
-from prf.utils import chunks
+from prf.utils import chunks, maybe_dotted
+from datasets.metrics import Metrics, NullMetrics, prometheus_file_exporter
+from datasets.joblog import build_log_sink
+from datasets.checkpoint import build_checkpoints, checkpoint_state
+from datasets.pkfilter import build_pk_filter
+from datasets.sizing import byte_chunks, ChunkSizer
+from datasets.retry import RetryQueue
 
 log = logging.getLogger(__name__)
 
+# tells the sink thread that producers are done
+_CLOSE_SINK = object()
+
+INDEX_POLICIES = ['ignore', 'warn', 'create', 'refuse']
+
+
+def payload_size(obj):
+    '''
+        Cheap estimate of how many bytes `obj` takes once serialized.
+        Used for the write buffer byte budget, so it only needs to be in the right ballpark.
+    '''
+    if isinstance(obj, dict):
+        return sum(len(str(k)) + payload_size(v) for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple, set)):
+        return sum(payload_size(v) for v in obj)
+
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+
+    return 8
+
+
+DEFAULT_TOKENS = {
+    '__OID__': lambda: str(ObjectId()),
+    '__TODAY__': datetime.today,
+    '__NOW__': datetime.now,
+}
+
+def set_missing(data, path, val):
+    '''
+        Set nested `path` of `data` to `val` unless it is already there. Returns True if set.
+    '''
+    for key in path[:-1]:
+        sub = data.get(key)
+        if sub is None:
+            sub = data[key] = slovar()
+        elif not isinstance(sub, dict):
+            return False
+        data = sub
+
+    if path[-1] in data:
+        return False
+
+    # defaults are shared by all records, don't hand out the same list/dict
+    data[path[-1]] = deepcopy(val) if isinstance(val, (dict, list)) else val
+    return True
+
+
+def is_plain_field(name):
+    #top level field name without extract syntax (nesting, renames, wildcards, exclusions)
+    return bool(name) and not any(it in name for it in ['.', '__', '*', ':', '-', '='])
+
+
+def to_columns(batch):
+    '''
+        Normalize a columnar batch (dict of lists or NumPy arrays, Arrow RecordBatch or Table) to a dict of lists.
+    '''
+    if hasattr(batch, 'to_pydict'):
+        return batch.to_pydict()
+
+    return {name: col.tolist() if hasattr(col, 'tolist') else list(col)
+                for name, col in batch.items()}
+
+
+def ibatches(iterable, size):
+    '''
+        Like `prf.utils.chunks` but for iterators of unknown length.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# backend copy living in a preparation worker process
+_prepare_backend = None
+
+def _init_prepare_worker(backend):
+    global _prepare_backend
+    # do not inherit the parent lock state
+    backend._buffer_lock = Lock()
+    backend.drain_buffers()
+    # only what this worker records goes back to the parent
+    backend.metrics.drain()
+    _prepare_backend = backend
+
+def _prepare_records(records):
+    return _prepare_backend.prepare_records(records)
+
+
+async def aiter_dataset(dataset, skip=0):
+    if not hasattr(dataset, '__aiter__'):
+        for data in islice(dataset, skip, None):
+            yield data
+        return
+
+    async for data in dataset:
+        if skip:
+            skip -= 1
+            continue
+        yield data
+
 
 class Base(object):
     _operations = slovar()
+    #backends that must write chunks in order (e.g. appending to a file) set this
+    _ordered_flush = False
+    #request size cap used by `adaptive_flush` when `flush_max_bytes` is not set
+    max_flush_bytes = 0
 
     @classmethod
     def process_ds(cls, ds):
@@ -46,6 +168,7 @@ class Base(object):
             raise KeyError('Invalid operations %s' % list(invalid_ops))
 
     def __init__(self, params, job_log=None):
+        init_start = time.perf_counter()
         params = slovar.copy(params)
 
         self.define_op(params, 'asstr',  'name', raise_on_values=['', None])
@@ -64,19 +187,45 @@ class Base(object):
         self.define_op(params, 'asbool', 'fail_on_error', default=True)
         self.define_op(params, 'asstr',  'op')
         self.define_op(params, 'aslist', 'skip_by', allow_missing=True)
+        self.define_op(params, 'asstr',  'skip_filter', allow_missing=True)
         self.define_op(params, 'asstr',  'backend', allow_missing=True)
         self.define_op(params, 'asstr',  'ns', raise_on_values=[None])
 
         self.define_op(params, 'aslist', 'pk', allow_missing=True)
         self.define_op(params, 'asbool', 'skip_timestamp', default=False)
         self.define_op(params, 'asbool', 'verbose_logging', default=False)
+        self.define_op(params, 'asint',  'log_every', default=1)
+        self.define_op(params, 'asint',  'log_first', default=0)
         self.define_op(params, 'asbool', 'update_multi', default=False)
+        self.define_op(params, 'asstr',  'index_policy', default='warn', mod=str.lower)
 
         self.define_op(params, 'asint', 'write_buffer_size', default=1000)
+        self.define_op(params, 'asint', 'write_buffer_bytes', default=0)
+        self.define_op(params, 'asint', 'flush_max_bytes', default=0)
+        self.define_op(params, 'asbool', 'adaptive_flush', default=False)
+        self.define_op(params, 'asfloat', 'flush_target_latency', default=1.0)
+        self.define_op(params, 'asint', 'flush_target_bytes', default=0)
+        self.define_op(params, 'asbool', 'stream_flush', default=False)
         self.define_op(params, 'asint', 'flush_retries', default=2)
+        self.define_op(params, 'asfloat', 'retry_backoff', default=0.5)
+        self.define_op(params, 'asfloat', 'retry_max_backoff', default=30.0)
+        self.define_op(params, 'asint', 'flush_workers', default=1)
+        self.define_op(params, 'asint', 'prepare_workers', default=0)
+        self.define_op(params, 'asint', 'sink_queue_size', default=10000)
+        self.define_op(params, 'asfloat', 'sink_flush_interval', default=1.0)
 
         self.define_op(params, 'asstr',  'log_ds', default='', mod=str.lower)
         self.define_op(params, 'asbool',  'skip_logs', default=False)
+        self.define_op(params, 'asstr',  'log_sink', default='es', mod=str.lower)
+        self.define_op(params, 'asstr',  'log_mode', default='record', mod=str.lower)
+        self.define_op(params, 'asstr',  'log_file', allow_missing=True)
+        self.define_op(params, 'asint',  'log_batch_size', default=1000)
+        self.define_op(params, 'asstr',  'job_id', allow_missing=True)
+        self.define_op(params, 'asstr',  'checkpoint', allow_missing=True)
+
+        self.define_op(params, 'asbool', 'metrics', default=False)
+        self.define_op(params, 'asstr',  'metrics_file', allow_missing=True)
+        self.define_op(params, 'asstr',  'metrics_callback', allow_missing=True)
 
         self._operations['query'] = dict
         self._operations['default'] = dict
@@ -94,44 +243,849 @@ class Base(object):
         self.klass = datasets.get_dataset(self.params, define=True)
 
         self.job_log = job_log or slovar()
+        self._defaults = self.compile_defaults()
+        self._pk_keys = self.compile_pk()
+        self._action_counts = {}
 
         self._buffer_lock = Lock()
         self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_sizes = []
         self._log_buffer = []
 
-    def process_many(self, dataset):
-        for data in dataset:
-            self.process(data)
+        self.chunk_sizer = self.build_chunk_sizer()
+        self.flush_max_bytes = self.params.flush_max_bytes or (self.max_flush_bytes if self.chunk_sizer else 0)
+        # item sizes are only worked out when something needs them
+        self._sized_buffer = bool(self.params.write_buffer_bytes or self.flush_max_bytes or self.chunk_sizer)
+        self.log_sink = self.build_log_sink()
+
+        if self.params.index_policy not in INDEX_POLICIES:
+            raise ValueError('`index_policy` must be one of %s, got `%s`' % (INDEX_POLICIES, self.params.index_policy))
+        self._preflight_done = False
+
+        self.flush_workers = self.params.flush_workers
+        if self._ordered_flush and self.flush_workers > 1:
+            log.warning('%s writes in order. Ignoring flush_workers=%s',
+                            self.__class__.__name__, self.flush_workers)
+            self.flush_workers = 1
+
+        self.pk_filter = None
+        self._use_pk_filter = bool(self.params.get('skip_filter'))
+        self._skipped = 0
+        if self._use_pk_filter and not self.params.is_insert:
+            log.warning('`skip_filter` is only used by `create` jobs with `skip_by`. Ignoring it')
+            self._use_pk_filter = False
+
+        self.prepare_workers = self.params.prepare_workers
+        if self.prepare_workers and not self.can_prepare_in_workers():
+            log.warning('`%s` op of %s can not be prepared in worker processes (skip_filter=%s). Ignoring prepare_workers=%s',
+                            self.params.op, self.__class__.__name__, self.params.get('skip_filter'), self.prepare_workers)
+            self.prepare_workers = 0
+
+        self._flush_executor = None
+        self._flushes = {}
+        self.flush_stats = slovar(total=0, success=0, errors=0)
+        self._flush_seq = 0
+
+        self.retry_queue = RetryQueue(self.params.retry_backoff, self.params.retry_max_backoff)
+        # requeued items not flushed for good yet, waiting in `retry_queue` or in flight
+        self._retry_pending = 0
+
+        self.checkpoints = self.build_checkpoints()
+        self._position = 0
+        self._position_marks = deque()
+        self._flushed = {}
+        self._committed = slovar(seq=0, total=0, success=0, errors=0)
+
+        self._sink_lock = Lock()
+        self._sink_queue = None
+        self._sink_thread = None
+        self._sink_error = None
+
+        self.metrics = self.build_metrics()
+        self.metrics.observe('init', time.perf_counter() - init_start)
+
+    def build_metrics(self):
+        if not self.params.metrics:
+            return NullMetrics()
+
+        exporters = []
+        if self.params.get('metrics_file'):
+            exporters.append(prometheus_file_exporter(self.params.metrics_file))
+        if self.params.get('metrics_callback'):
+            exporters.append(maybe_dotted(self.params.metrics_callback))
+
+        return Metrics(labels=dict(backend=self.params.get('backend') or self.__class__.__name__,
+                                   ns=self.params.ns, name=self.params.name, op=self.params.op),
+                       exporters=exporters)
+
+    def build_chunk_sizer(self):
+        if not self.params.adaptive_flush:
+            return None
+
+        size = self.params.write_buffer_size
+        return ChunkSizer(size, min_size=size//10, max_size=size*10,
+                          target_latency=self.params.flush_target_latency,
+                          target_bytes=self.params.flush_target_bytes)
+
+    def build_log_sink(self):
+        if self.params.log_mode not in ['record', 'summary']:
+            raise ValueError('`log_mode` must be `record` or `summary`, got `%s`' % self.params.log_mode)
+
+        if self.params.log_sink == 'summary':
+            self.params.log_mode = 'summary'
+
+        ds = self.params.get('log_file') if self.params.log_sink == 'file' else self.params.log_ds
+        return build_log_sink(self.params.log_sink, ds, batch_size=self.params.log_batch_size)
+
+    def build_checkpoints(self):
+        if not self.params.get('checkpoint'):
+            return None
+
+        if not self.params.get('job_id'):
+            raise ValueError('`checkpoint` needs a `job_id`')
+
+        if not self.params.stream_flush:
+            # positions are only committed when the buffer is flushed while reading
+            log.info('`checkpoint` is set, turning on `stream_flush`')
+            self.params.stream_flush = True
+
+        return build_checkpoints(self.params.checkpoint)
+
+    def resume(self, dataset):
+        '''
+            Skip the records committed by a previous run of the same `job_id`.
+        '''
+        position = self.resume_position()
+        if not position:
+            return dataset
+
+        return islice(dataset, position, None)
+
+    def resume_position(self):
+        '''
+            Number of records committed by a previous run of the same `job_id`, the counters start from there.
+        '''
+        if not self.checkpoints:
+            return 0
+
+        state = self.checkpoints.load(self.params.job_id)
+        if not state:
+            return 0
+
+        counts = state.extract(['total', 'success', 'errors'])
+        log.info('Resuming job `%s` from %s: skipping %s records%s', self.params.job_id, self.checkpoints,
+                        state.position, ' (job is done)' if state.get('done') else '')
+
+        self._position = state.position
+        self._committed.update(counts)
+        self.flush_stats.update(counts)
+
+        return state.position
+
+    def mark_position(self):
+        '''
+            Called after a whole buffer was submitted: once the flushes submitted so far are done,
+            every record read up to now is committed.
+        '''
+        if not self.checkpoints:
+            return
 
-        nb_retries = self.params.flush_retries
+        self._position_marks.append((self._position, self._flush_seq))
+        self.commit_checkpoint()
 
-        if self.params.dry_run:
+    def flush_done(self, seq, size, success, errors, retries=(), attempts=None):
+        if retries or attempts:
+            requeued, exhausted = self.schedule_retries(retries, attempts or {})
+            # requeued items are counted with the chunk they finally land in
+            size -= requeued
+            errors = list(errors or []) + exhausted
+
+        self.count_flush(size, success, errors)
+
+        if self.checkpoints:
+            self._flushed[seq] = (size, success, len(errors) if errors else 0)
+            self.commit_checkpoint()
+
+    def commit_checkpoint(self, done=False):
+        committed = self._committed
+
+        # flushes can finish out of order, only count them once all previous ones are done
+        while committed.seq+1 in self._flushed:
+            size, success, errors = self._flushed.pop(committed.seq+1)
+            committed.seq += 1
+            committed.total += size
+            committed.success += success
+            committed.errors += errors
+
+        if self._retry_pending and not done:
+            # some records read so far are still waiting for a retry
+            return
+
+        position = None
+        while self._position_marks and self._position_marks[0][1] <= committed.seq:
+            position = self._position_marks.popleft()[0]
+
+        if position is None and not done:
+            return
+
+        with self.metrics.timer('checkpoint'):
+            self.checkpoints.save(self.params.job_id,
+                                  checkpoint_state(self._position if done else position, committed, done=done))
+
+    def preflight(self):
+        '''
+            Checks run once, before the first record: for update, upsert and delete,
+            whether the target can look records up by `op_params` without a full scan.
+        '''
+        if self._preflight_done:
+            return
+        self._preflight_done = True
+
+        if self.params.index_policy == 'ignore' or not self.params.op_params \
+                or self.params.op not in ['update', 'upsert', 'delete']:
+            return
+
+        with self.metrics.timer('preflight'):
+            self.check_op_index()
+
+    def check_op_index(self):
+        '''
+            Apply `index_policy` when no index covers `op_params`:
+            `warn` logs the expected cost, `refuse` raises, `create` builds the index.
+        '''
+        covered, cost = self.op_index_status()
+        if covered:
+            log.debug('`%s` is indexed on %s', self.params.name, self.params.op_params)
+            return
+
+        msg = 'No index on %s of `%s` for `%s`: %s' % (self.params.op_params, self.params.name,
+                                                       self.params.op, cost)
+
+        if self.params.index_policy == 'refuse':
+            raise ValueError('%s. Use index_policy=create to build it, or warn to run anyway' % msg)
+
+        if self.params.index_policy == 'create' and not self.params.dry_run:
+            log.warning('%s. Creating it', msg)
+            self.create_op_index()
+        else:
+            log.warning(msg)
+
+    def op_index_status(self):
+        '''
+            `(covered, cost)`, `cost` describing what a lookup by `op_params` costs without the index.
+            Targets without indexes have nothing to check.
+        '''
+        return True, None
+
+    def create_op_index(self):
+        raise NotImplementedError('%s can not create indexes' % self.__class__.__name__)
+
+    def load_pk_filter(self):
+        '''
+            Build the `skip_filter` from the keys already in the target.
+        '''
+        if not self._use_pk_filter or self.pk_filter is not None:
             return
 
+        with self.metrics.timer('skip_filter_load'):
+            pk_filter = build_pk_filter(self.params.skip_filter, self.count_target())
+            for key in self.iter_target_keys():
+                pk_filter.add(key)
+
+        log.info('Loaded %s keys of `%s` into the %s skip filter',
+                    len(pk_filter), self.params.name, self.params.skip_filter)
+        self.pk_filter = pk_filter
+
+    def close_pk_filter(self):
+        if self.pk_filter is not None:
+            self.pk_filter.close()
+            self.pk_filter = None
+
+    def skip_known(self, key):
+        '''
+            True if a record with `key` is in the target already, so it would only fail as a duplicate.
+            New keys are remembered, repeats within the input are skipped too.
+        '''
+        if self.pk_filter is None:
+            self.load_pk_filter()
+
+        if key in self.pk_filter:
+            self._skipped += 1
+            self.metrics.incr('skipped')
+            return True
+
+        self.pk_filter.add(key)
+        return False
+
+    def skip_key(self, data):
+        values = data.extract(self.params.skip_by).flat()
+        return ':'.join(str(values.get(name)) for name in self.params.skip_by)
+
+    def count_target(self):
+        '''
+            Number of documents in the target, used to size the `skip_filter`.
+        '''
+        raise NotImplementedError('%s does not support `skip_filter`' % self.__class__.__name__)
+
+    def iter_target_keys(self):
+        '''
+            Keys of the documents in the target, as built by `skip_key`.
+        '''
+        raise NotImplementedError('%s does not support `skip_filter`' % self.__class__.__name__)
+
+    def close_log_sink(self):
+        if not self.log_sink:
+            return
+
+        errors = self.log_sink.close()
+        if errors:
+            self.raise_or_log(self.log_sink.stats.total, errors)
+
+    def job_result(self):
+        result = self.flush_stats.copy()
+        if self._use_pk_filter:
+            result['skipped'] = self._skipped
+        if self.log_sink:
+            result['logs'] = self.log_sink.stats.copy()
+        if self.metrics.enabled:
+            result['metrics'] = self.metrics.summary()
+        return result
+
+    def process_many(self, dataset):
+        streaming = self.params.stream_flush
+        dataset = self.resume(dataset)
+
+        # fork the preparation workers before the job opens target connections
+        pool = self.open_prepare_pool()
+
+        try:
+            self.start_job()
+
+            for nb_records in self.prepare(dataset, pool):
+                self._position += nb_records
+
+                if streaming and self.buffer_is_full():
+                    self.flush_buffer()
+
+            self.flush_buffer()
+            self.drain_retries()
+            self.close_log_sink()
+            self.commit_done()
+
+        finally:
+            if pool:
+                pool.terminate()
+            self.end_job()
+
+        return self.job_result()
+
+    def start_job(self):
+        '''
+            Run before the first record by `process_many` and `aprocess_many`.
+        '''
+        self.preflight()
+        self.load_pk_filter()
+
+    def commit_done(self):
+        if self.checkpoints and not self.params.dry_run:
+            self.commit_checkpoint(done=True)
+
+    def end_job(self):
+        '''
+            Release what the job holds, whether it succeeded or not.
+        '''
+        self.shutdown_flushes()
+        if self.log_sink:
+            self.log_sink.close()
+        self.close_pk_filter()
+        self.metrics.export()
+
+    def process_batches(self, batches):
+        '''
+            Columnar input for `process_many`. Each batch is a dict of columns (lists or NumPy arrays)
+            or an Arrow RecordBatch, and is turned into rows that go through `process` as usual.
+        '''
+        return self.process_many(self.iter_batch_rows(batches))
+
+    def iter_batch_rows(self, batches):
+        for batch in batches:
+            columns = to_columns(batch)
+            names = list(columns.keys())
+
+            for values in zip(*columns.values()):
+                yield slovar(zip(names, values))
+
+    def open_prepare_pool(self):
+        '''
+            Worker processes for `prepare`, or None without `prepare_workers`. Forked, so the workers get
+            this backend without pickling it. Call it before `start_job`: forking once a target client
+            has connected is not safe.
+        '''
+        if not self.prepare_workers:
+            return None
+
+        context = multiprocessing.get_context('fork')
+        return context.Pool(self.prepare_workers, initializer=_init_prepare_worker, initargs=(self,))
+
+    def prepare(self, dataset, pool=None):
+        '''
+            Run `process` over `dataset`, yielding the number of records read every time new items land in the buffer.
+            With a `pool` from `open_prepare_pool`, records are sharded in `write_buffer_size` batches across worker
+            processes, and only the finished buffer items come back. Batches are merged in input order.
+        '''
+        if pool is None:
+            for data in dataset:
+                self.process(data)
+                yield 1
+            return
+
+        pending = deque()
+
+        for batch in ibatches(dataset, self.params.write_buffer_size):
+            pending.append((pool.apply_async(_prepare_records, (batch,)), len(batch)))
+
+            # keep a couple batches per worker queued, don't read the whole input ahead
+            if len(pending) >= 2*self.prepare_workers:
+                yield self.add_prepared(*pending.popleft())
+
+        while pending:
+            yield self.add_prepared(*pending.popleft())
+
+    def add_prepared(self, result, nb_records):
+        with self.metrics.timer('prepare_wait'):
+            items, log_items, sizes, metrics = result.get()
+
+        self.buffer_extend(items, log_items, sizes)
+        self.metrics.merge(metrics)
+        return nb_records
+
+    def can_prepare_in_workers(self):
+        '''
+            True when `process` only builds buffer items and does not talk to the target.
+            Not with `skip_filter`: the skip counts and the keys seen would stay in the workers.
+        '''
+        return not self._use_pk_filter
+
+    def prepare_records(self, records):
+        for data in records:
+            self.process(data)
+
+        items, log_items, sizes = self.drain_buffers()
+        return [self.export_buffer_item(it) for it in items], log_items, sizes, self.metrics.drain()
+
+    def export_buffer_item(self, item):
+        '''
+            Turn a buffer item into something that can be sent back from a preparation worker.
+        '''
+        return item
+
+    def submit(self, data):
+        '''
+            Queue a record for the background sink thread. Safe to call from many producer threads.
+            Blocks while `sink_queue_size` records are waiting, which throttles producers to the write speed.
+        '''
+        if self._sink_error:
+            raise self._sink_error
+
+        if not self._sink_thread:
+            self.open_sink()
+
+        with self.metrics.timer('sink_wait'):
+            self._sink_queue.put(data)
+
+    def open_sink(self):
+        with self._sink_lock:
+            if self._sink_thread:
+                return
+
+            if self.checkpoints:
+                raise ValueError('`checkpoint` can not be used with `submit`: '
+                                 'records from several producers have no position to resume from')
+
+            self.preflight()
+
+            self._sink_queue = queue.Queue(maxsize=self.params.sink_queue_size)
+            self._sink_thread = Thread(target=self.run_sink, daemon=True,
+                                       name='sink-%s' % self.params.name)
+            self._sink_thread.start()
+
+    def close(self):
+        '''
+            Wait for the sink thread to process and flush everything submitted so far.
+        '''
+        with self._sink_lock:
+            if self._sink_thread:
+                self._sink_queue.put(_CLOSE_SINK)
+                self._sink_thread.join()
+                self._sink_thread = None
+
+        if self._sink_error:
+            raise self._sink_error
+
+        return self.job_result()
+
+    def run_sink(self):
+        try:
+            while True:
+                try:
+                    data = self._sink_queue.get(timeout=self.params.sink_flush_interval)
+                except queue.Empty:
+                    # producers are idle, don't sit on a partial buffer
+                    self.flush_buffer()
+                    continue
+
+                if data is _CLOSE_SINK:
+                    break
+
+                self.process(data)
+
+                if self.buffer_is_full():
+                    self.flush_buffer()
+
+            self.flush_buffer()
+            self.drain_retries()
+            self.close_log_sink()
+
+        except Exception as e:
+            log.error('Sink for `%s` failed: %r', self.params.name, e)
+            self._sink_error = e
+
+            # unblock producers waiting on a full queue until close() is called
+            while self._sink_queue.get() is not _CLOSE_SINK:
+                pass
+
+        finally:
+            self.end_job()
+
+    def buffer_append(self, item, data=None):
+        '''
+            Add `item` (document, bulk action, row) to the write buffer.
+            `data` is the record the item was built from, used to account the byte budget
+            when `item` itself is not a plain dict.
+        '''
+        with self._buffer_lock:
+            self._buffer.append(item)
+            if self._sized_buffer:
+                size = payload_size(item if data is None else data)
+                self._buffer_sizes.append(size)
+                self._buffer_bytes += size
+
+    def buffer_extend(self, items, log_items=[], sizes=None):
+        with self._buffer_lock:
+            self._buffer.extend(items)
+            self._log_buffer.extend(log_items)
+            if self._sized_buffer:
+                sizes = sizes or [payload_size(it) for it in items]
+                self._buffer_sizes.extend(sizes)
+                self._buffer_bytes += sum(sizes)
+
+    def buffer_is_full(self):
+        # with `adaptive_flush` the buffer holds one chunk of the current size, so chunks can grow
+        size = self.chunk_sizer.size if self.chunk_sizer else self.params.write_buffer_size
+        if len(self._buffer) >= size:
+            return True
+
+        return bool(self.params.write_buffer_bytes and
+                    self._buffer_bytes >= self.params.write_buffer_bytes)
+
+    def drain_buffers(self):
         with self._buffer_lock:
             flush_buffer = self._buffer
             flush_log_buffer = self._log_buffer
+            flush_sizes = self._buffer_sizes
             self._buffer = []
             self._log_buffer = []
+            self._buffer_sizes = []
+            self._buffer_bytes = 0
+
+        return flush_buffer, flush_log_buffer, flush_sizes
+
+    def iter_chunks(self, items, sizes):
+        '''
+            Split drained buffer items into flush chunks, yielding `(chunk, nb_bytes)`.
+            Plain `write_buffer_size` chunks, unless `flush_max_bytes` caps the request size
+            or `adaptive_flush` picks the number of items per chunk.
+        '''
+        if not (self.flush_max_bytes or self.chunk_sizer):
+            for chunk in chunks(items, self.params.write_buffer_size):
+                yield chunk, 0
+            return
+
+        yield from byte_chunks(items, sizes, self.chunk_sizer or self.params.write_buffer_size,
+                               self.flush_max_bytes)
+
+    def flush_buffer(self):
+        flush_buffer, flush_log_buffer, flush_sizes = self.drain_buffers()
+
+        if self.params.dry_run:
+            return
+
+        attempts = {}
+        due = self.retry_queue.pop_due() if self._retry_pending else []
+        if due:
+            # due retries go first, merged with the new items
+            items = [it for it, _ in due]
+            attempts = {id(it): attempt for it, attempt in due}
+            flush_buffer = items + flush_buffer
+            if self._sized_buffer:
+                flush_sizes = [self.item_size(it) for it in items] + flush_sizes
+
+        for chunk, nb_bytes in self.iter_chunks(flush_buffer, flush_sizes):
+            chunk_attempts = None
+            if attempts:
+                chunk_attempts = {id(it): attempts[id(it)] for it in chunk if id(it) in attempts}
+            self.submit_flush(chunk, nb_bytes, chunk_attempts)
+
+        self.mark_position()
+
+        if flush_log_buffer:
+            with self.metrics.timer('log_queue'):
+                self.log_sink.add(flush_log_buffer)
+
+    def flush_chunk(self, chunk, nb_bytes=0):
+        '''
+            Returns `(success, errors, retries)`. Retryable items are requeued by `flush_done`.
+        '''
+        success, errors, retries = self.timed_flush(chunk, nb_bytes)
+
+        if errors:
+            self.raise_or_log(len(chunk), errors)
+
+        return success, errors, retries or []
+
+    def schedule_retries(self, retries, attempts):
+        '''
+            Requeue `retries` with backoff. `attempts` are the earlier attempts of the requeued
+            items of the chunk. Returns the number of requeued items and the errors for the ones out of retries.
+        '''
+        self._retry_pending -= len(attempts)
+
+        exhausted = []
+        for item in retries:
+            attempt = attempts.get(id(item), 0) + 1
+            if attempt > self.params.flush_retries:
+                exhausted.append({'error': 'still failing after %s retries' % self.params.flush_retries})
+            else:
+                self.retry_queue.push(item, attempt)
+                self._retry_pending += 1
+
+        requeued = len(retries) - len(exhausted)
+        if requeued:
+            log.debug('RETRY BULK FLUSH for %s docs', requeued)
+            self.metrics.incr('retries', requeued)
+
+        if exhausted:
+            self.raise_or_log(len(retries), exhausted)
+
+        return requeued, exhausted
+
+    def drain_retries(self):
+        '''
+            End of the job: wait for the flushes in flight, then flush the requeued items as they come due.
+        '''
+        while True:
+            self.wait_flushes()
+            if not self._retry_pending:
+                return
+
+            delay = self.retry_queue.next_delay()
+            if delay:
+                with self.metrics.timer('retry_wait'):
+                    time.sleep(delay)
+
+            self.flush_buffer()
+
+    def timed_flush(self, chunk, nb_bytes=0):
+        if not (self.metrics.enabled or self.chunk_sizer):
+            return self.flush(chunk)
+
+        start = time.perf_counter()
+        result = self.flush(chunk)
+        self.observe_flush(chunk, nb_bytes, time.perf_counter() - start, result[2])
+
+        return result
+
+    def observe_flush(self, chunk, nb_bytes, seconds, retries):
+        if not nb_bytes and (self.metrics.enabled or self.params.flush_target_bytes):
+            nb_bytes = sum(self.item_size(it) for it in chunk)
+
+        self.metrics.observe('flush', seconds)
+        self.metrics.add_bytes('flush', nb_bytes)
+
+        if self.chunk_sizer:
+            # retries are the items the target pushed back on, e.g. ES 429
+            self.chunk_sizer.observe(len(chunk), nb_bytes, seconds, throttled=bool(retries))
+
+    def item_size(self, item):
+        return payload_size(item)
+
+    def submit_flush(self, chunk, nb_bytes=0, attempts=None):
+        '''
+            Flush `chunk` inline or, with `flush_workers` > 1, on the flush executor.
+            At most `flush_workers` bulk requests are in flight, further chunks wait for a free slot.
+        '''
+        self._flush_seq += 1
+
+        if self.flush_workers < 2:
+            self.flush_done(self._flush_seq, len(chunk), *self.flush_chunk(chunk, nb_bytes),
+                            attempts=attempts)
+            return
+
+        if not self._flush_executor:
+            self._flush_executor = ThreadPoolExecutor(max_workers=self.flush_workers)
+
+        if len(self._flushes) >= self.flush_workers:
+            with self.metrics.timer('flush_wait'):
+                while len(self._flushes) >= self.flush_workers:
+                    self.wait_flushes(return_when=FIRST_COMPLETED)
+
+        future = self._flush_executor.submit(self.flush_chunk, chunk, nb_bytes)
+        self._flushes[future] = (self._flush_seq, len(chunk), attempts)
+
+    def wait_flushes(self, return_when=ALL_COMPLETED):
+        if not self._flushes:
+            return
+
+        done, _ = wait(list(self._flushes.keys()), return_when=return_when)
+        for future in done:
+            seq, size, attempts = self._flushes.pop(future)
+            # raises if the chunk failed and `fail_on_error` is set
+            self.flush_done(seq, size, *future.result(), attempts=attempts)
+
+    def shutdown_flushes(self):
+        for future in self._flushes:
+            future.cancel()
+        self._flushes = {}
+
+        if self._flush_executor:
+            self._flush_executor.shutdown(wait=True)
+            self._flush_executor = None
+
+    async def aprocess_many(self, dataset):
+        '''
+            asyncio counterpart of `process_many`. `dataset` can be a regular or an async iterable.
+            Chunks are written through `aflush` with at most `flush_workers` of them in flight,
+            so several backends can write concurrently on the same event loop.
+        '''
+        streaming = self.params.stream_flush
+        self._aflush_slots = asyncio.Semaphore(self.flush_workers)
+        self._aflushes = []
+
+        try:
+            skip = await self.run_blocking(self.resume_position)
+            await self.run_blocking(self.start_job)
+
+            async for data in aiter_dataset(dataset, skip):
+                self.process(data)
+                self._position += 1
+
+                if streaming and self.buffer_is_full():
+                    await self.aflush_buffer()
+
+            await self.aflush_buffer()
+
+            for result in await asyncio.gather(*self._aflushes):
+                self.flush_done(*result)
+            self._aflushes = []
+
+            await self.run_blocking(self.close_log_sink)
+            self.commit_done()
+
+        finally:
+            for task in self._aflushes:
+                task.cancel()
+            self._aflushes = []
+            self.end_job()
+
+        return self.job_result()
+
+    async def aflush_buffer(self):
+        flush_buffer, flush_log_buffer, flush_sizes = self.drain_buffers()
+
+        if self.params.dry_run:
+            return
 
-        for chunk in chunks(flush_buffer, self.params.write_buffer_size):
-            success, errors, retries = self.flush(chunk)
-            while(retries and nb_retries):
+        for chunk, nb_bytes in self.iter_chunks(flush_buffer, flush_sizes):
+            await self._aflush_slots.acquire()
+            self.collect_aflushes()
+            self._flush_seq += 1
+            self._aflushes.append(asyncio.ensure_future(self.aflush_chunk(chunk, nb_bytes, self._flush_seq)))
+
+        self.mark_position()
+
+        if flush_log_buffer:
+            # the writer thread has its own batching, this only blocks when its queue is full
+            await self.run_blocking(self.log_sink.add, flush_log_buffer)
+
+    def collect_aflushes(self):
+        for task in [it for it in self._aflushes if it.done()]:
+            self._aflushes.remove(task)
+            # raises if the chunk failed and `fail_on_error` is set
+            self.flush_done(*task.result())
+
+    async def aflush_chunk(self, chunk, nb_bytes=0, seq=0):
+        '''
+            Returns `(seq, size, success, errors)`, retryable items are retried here after a backoff.
+        '''
+        try:
+            success, errors, retries = await self.atimed_flush(chunk, nb_bytes)
+
+            attempt = 0
+            while retries and attempt < self.params.flush_retries:
+                attempt += 1
                 log.debug('RETRY BULK FLUSH for %s docs', len(retries))
-                success2, errors2, retries = self.flush(retries)
+                self.metrics.incr('retries', len(retries))
+
+                # only this chunk waits, the other flushes go on
+                with self.metrics.timer('retry_wait'):
+                    await asyncio.sleep(self.retry_queue.backoff(attempt))
+
+                success2, errors2, retries = await self.atimed_flush(retries)
                 success +=success2
                 errors +=errors2
-                nb_retries -=1
+
+            if retries:
+                errors = list(errors) + [{'error': 'still failing after %s retries' % attempt}]*len(retries)
 
             if errors:
                 self.raise_or_log(len(chunk), errors)
 
-            first_chunk = False
+            return seq, len(chunk), success, errors
 
-        for chunk in chunks(flush_log_buffer, self.params.write_buffer_size):
-            success, errors, retries = ES.flush(chunk)
-            if errors:
-                self.raise_or_log(len(chunk), errors)
+        finally:
+            self._aflush_slots.release()
+
+    async def atimed_flush(self, chunk, nb_bytes=0):
+        if not (self.metrics.enabled or self.chunk_sizer):
+            return await self.aflush(chunk)
+
+        start = time.perf_counter()
+        result = await self.aflush(chunk)
+        self.observe_flush(chunk, nb_bytes, time.perf_counter() - start, result[2])
+
+        return result
+
+    async def aflush(self, chunk):
+        '''
+            Backends with a non-blocking client override this.
+            By default the blocking `flush` runs in the loop's executor.
+        '''
+        return await self.run_blocking(self.flush, chunk)
+
+    def run_blocking(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def count_flush(self, size, success, errors):
+        self.flush_stats.total += size
+        self.flush_stats.success += success
+        self.flush_stats.errors += len(errors) if errors else 0
+
+        self.metrics.incr('written', success)
+        self.metrics.incr('errors', len(errors) if errors else 0)
+
+        if self.log_sink and self.params.log_mode == 'summary':
+            self.log_sink.add([self.build_chunk_log(size, success, errors)])
 
     def raise_or_log(self, data_size, errors):
         msg = '`%s` out of `%s` documents failed to index\n%.1024s' % (len(errors), data_size, errors)
@@ -141,7 +1095,12 @@ class Base(object):
             log.error(msg)
 
     def process(self, data):
-        data = self.add_defaults(data)
+        with self.metrics.timer('process'):
+            return self.process_one(data)
+
+    def process_one(self, data):
+        with self.metrics.timer('add_defaults'):
+            data = self.add_defaults(data)
 
         _op = self.params.op
         _op_params = self.params.op_params
@@ -165,6 +1124,23 @@ class Base(object):
             raise KeyError(
                 'Must provide `op` param. e.g. op=update:key1,key2')
 
+    def should_log_action(self, action, logger=log):
+        '''
+            Checked before an action message is built: `logger` must emit it (warning on dry runs, debug otherwise)
+            and it must pass the `log_every`/`log_first` sampling, counted per action.
+        '''
+        level = logging.WARNING if self.params.dry_run else logging.DEBUG
+        if not logger.isEnabledFor(level):
+            return False
+
+        count = self._action_counts.get(action, 0) + 1
+        self._action_counts[action] = count
+
+        if self.params.log_first and count > self.params.log_first:
+            return False
+
+        return self.params.log_every <= 1 or (count - 1) % self.params.log_every == 0
+
     def format4logging(self, query={}, data={}):
 
         if not self.params.verbose_logging:
@@ -193,28 +1169,51 @@ class Base(object):
 
         return '\n'.join(msg)
 
-    def add_defaults(self, data):
+    def compile_defaults(self):
+        '''
+            Split the `default` param once per job into static values, typecast up front,
+            and dynamic `__OID__`/`__TODAY__`/`__NOW__` tokens that are resolved per record.
+        '''
         if not self.params.get('default'):
+            return None
+
+        static = slovar()
+        dynamic = []
+
+        for key, val in slovar(self.params.default).flat().items():
+            if isinstance(val, str) and val in DEFAULT_TOKENS:
+                dynamic.append((key, val))
+            else:
+                static[key] = val
+
+        return slovar(
+            static=[(key.split('.'), val) for key, val in typecast(static).items()],
+            dynamic=dynamic,
+        )
+
+    def add_defaults(self, data):
+        if not self._defaults:
             return data
 
-        default_f = self.params.default.flat()
+        added = []
+
+        for path, val in self._defaults.static:
+            if set_missing(data, path, val):
+                added.append('.'.join(path))
 
-        for k in default_f:
-            if default_f[k] == '__OID__':
-                default_f[k] = str(ObjectId())
-            elif default_f[k] == '__TODAY__':
-                default_f[k] = datetime.today()
-            elif default_f[k] == '__NOW__':
-                default_f[k] = datetime.now()
+        for key, token in self._defaults.dynamic:
+            val = DEFAULT_TOKENS[token]()
+            if '__' in key:
+                # typed key, e.g. `start__asstr`
+                (key, val), = typecast({key: val}).items()
 
-        default_f = typecast(default_f)
-        data_f = data.flat()
+            if set_missing(data, key.split('.'), val):
+                added.append(key)
 
-        dkeys = default_f.key_diff(data_f.keys())
-        if dkeys:
-            log.debug('DEFAULT values for %s:\n %s', dkeys, pformat(default_f.extract(dkeys)))
+        if added and log.isEnabledFor(logging.DEBUG):
+            log.debug('DEFAULT values for %s:\n %s', added, pformat(data.flat().extract(added)))
 
-        return data_f.update_with(default_f, overwrite=0).unflat()
+        return data
 
     def log_not_found(self, params, data, tags=[], msg=''):
         msg = msg or 'NOT FOUND in <%s> with:\n%s' % (self.klass,
@@ -227,25 +1226,46 @@ class Base(object):
     def process_empty(self, data):
         if self.params.pop_empty:
             if isinstance(self.params.pop_empty, bool):
-                data = data.pop_by_values(['', None, []])
+                ekeys = list(data.keys())
             else:
-                for ekey in self.params.pop_empty:
-                    if ekey in data and data[ekey] in ['', None, []]:
-                        data.pop(ekey)
+                ekeys = self.params.pop_empty
+
+            for ekey in ekeys:
+                if ekey in data and data[ekey] in ['', None, []]:
+                    data.pop(ekey)
         return data
 
+    def compile_pk(self):
+        '''
+            Sorted pk field names when they are all plain top level fields, so `build_pk` can skip `extract`.
+        '''
+        pk = self.params.pk
+        keys = split_strip(pk) if isinstance(pk, str) else list(pk)
+
+        if keys and all(is_plain_field(it) for it in keys):
+            return sorted(keys)
+
     def build_pk(self, data):
-        if 'id' == self.params.pk:
-            if self.params.pk not in data:
-                data[self.params.pk] = str(ObjectId())
-                return self.params.pk, data[self.params.pk]
+        with self.metrics.timer('build_pk'):
+            if 'id' == self.params.pk:
+                if self.params.pk not in data:
+                    data[self.params.pk] = str(ObjectId())
+                    return self.params.pk, data[self.params.pk]
+
+            if self._pk_keys:
+                pk_data = slovar((kk, data[kk]) for kk in self._pk_keys if kk in data)
+                if not any(isinstance(it, dict) for it in pk_data.values()):
+                    if not pk_data:
+                        raise KeyError('missing data for pk `%s`' % (self.params.pk))
+
+                    return ':'.join(pk_data.keys()), ':'.join(str(it) for it in pk_data.values())
 
-        pk_data = data.extract(self.params.pk).flat()
+            pk_data = data.extract(self.params.pk).flat()
 
-        if not pk_data:
-            raise KeyError('missing data for pk `%s`' % (self.params.pk))
+            if not pk_data:
+                raise KeyError('missing data for pk `%s`' % (self.params.pk))
 
-        return pk_data.concat_values(sep=':')
+            return pk_data.concat_values(sep=':')
 
     def process_logs(self, data):
         def build_log(data):
@@ -259,21 +1279,21 @@ class Base(object):
 
         log = build_log(data)
 
-        if not self.params.get('log_ds'):
-            return log
-
-        action = slovar({
-            '_index': self.params.log_ds,
-            '_op_type': 'create',
-            '_source': log.unflat()
-        })
-
-        if ES.version.major < 7:
-            action['_type'] = 'notanalyzed'
+        if self.log_sink and self.params.log_mode == 'record':
+            self._log_buffer.append(log)
 
-        self._log_buffer.append(action)
         return log
 
+    def build_chunk_log(self, size, success, errors):
+        '''
+            One job log per flushed chunk, for `log_mode=summary`.
+        '''
+        return self.job_log.update_with(slovar({
+            'id': str(ObjectId()),
+            'target_chunk': slovar(total=size, success=success, errors=len(errors) if errors else 0),
+            'created_at': datetime.utcnow(),
+        }))
+
     def process_fields(self, data):
         return typecast(data.extract(self.params.fields))
 
@@ -284,29 +1304,30 @@ class Base(object):
         return data['logs']
 
     def pre_save(self, data):
-        is_new = self.params.op == 'create'
+        with self.metrics.timer('pre_save'):
+            is_new = self.params.op == 'create'
 
-        log = self.process_logs(data)
-        #save logs to add it back at the end
-        logs = self.add_logs(data, log)
+            log = self.process_logs(data)
+            #save logs to add it back at the end
+            logs = self.add_logs(data, log)
 
-        data = self.process_empty(data)
+            data = self.process_empty(data)
 
-        if 'fields' in self.params:
-            data = self.process_fields(data)
+            if 'fields' in self.params:
+                data = self.process_fields(data)
 
-        if not data:
-            return data
+            if not data:
+                return data
 
-        if not self.params.skip_timestamp:
-            _now = datetime.utcnow()
-            if is_new:
-                data['created_at'] = _now
+            if not self.params.skip_timestamp:
+                _now = datetime.utcnow()
+                if is_new:
+                    data['created_at'] = _now
 
-            data['updated_at'] = _now
+                data['updated_at'] = _now
 
-        if not self.params.skip_logs:
-            data['logs'] = logs
+            if not self.params.skip_logs:
+                data['logs'] = logs
 
-        return data
+            return data
 
@@ -23,6 +23,7 @@ class Results(list):
         self.specials = specials
 
 class CSVBackend(Base):
+    _ordered_flush = True
 
     @classmethod
     def ls_namespaces(cls):
@@ -86,6 +87,8 @@ class CSVBackend(Base):
             os.makedirs(dir_path)
 
         self.file_name = os.path.join(self.params.csv_root, self.params.ns, self.params.name)
+        #only the first flush may truncate the file, later ones append to it.
+        self._truncate = self.params.drop
 
     def get_transformer(self):
         if self.params.get('transformer'):
@@ -95,7 +98,7 @@ class CSVBackend(Base):
 
     def flush(self, objs, **kw):
         #if file already exists, append to it since data is being processed in batches.
-        if not self.params.drop and os.path.isfile(self.file_name) and os.path.getsize(self.file_name):
+        if not self._truncate and os.path.isfile(self.file_name) and os.path.getsize(self.file_name):
             file_opts = 'a+'
             skip_headers = True
         else:
@@ -106,12 +109,17 @@ class CSVBackend(Base):
             csv_data = dict2tab(objs, self.params.fields, 'csv', skip_headers)
             csv_file.write(csv_data)
 
+        self._truncate = False
+
         success = total = len(objs)
         log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s', total, success, 0, 0)
 
         return success, 0, 0
 
     def log_action(self, data, action):
+        if not self.should_log_action(action, log):
+            return
+
         msg = '%s\n%s' % (action.upper(), self.format4logging(data=data))
         if self.params.dry_run:
             log.warning('DRY RUN: %s' % msg)
@@ -121,8 +129,7 @@ class CSVBackend(Base):
     def create(self, data):
         data = data.extract(self.params.fields)
 
-        with self._buffer_lock:
-            self._buffer.append(data)
+        self.buffer_append(data)
 
         self.log_action(data, 'create')
 
@@ -1,5 +1,5 @@
 import logging
-from elasticsearch import TransportError
+from elasticsearch import TransportError, NotFoundError, helpers
 from bson import ObjectId
 from pprint import pformat
 
@@ -10,9 +10,21 @@ from prf.utils import chunks
 
 import datasets
 from datasets.backends.base import Base
+from datasets.catalog import Catalog
+from datasets.eswriter import BulkWriter
 
 log = logging.getLogger(__name__)
 
+# too many requests, unavailable, and `N/A` for connection errors with no response
+RETRY_STATUSES = frozenset([429, 503, 'N/A'])
+
+# field types that match exact values in term lookups
+EXACT_TYPES = frozenset(['keyword', 'long', 'integer', 'short', 'byte', 'double', 'float',
+                         'date', 'boolean', 'ip'])
+
+# index listings, refreshed when indices are created or dropped from here
+catalog = Catalog()
+
 
 NOT_ANALLYZED = {
     "dynamic_templates": [
@@ -30,8 +42,43 @@ NOT_ANALLYZED = {
 }
 
 
+def field_mapping(mappings, field):
+    '''
+        Mapping of the dotted `field`, in the `mappings` of an index, with or without doc types.
+    '''
+    roots = [mappings] if 'properties' in mappings else list(mappings.values())
+
+    for root in roots:
+        node = root
+        for part in field.split('.'):
+            node = node.get('properties', {}).get(part)
+            if not node:
+                break
+        if node:
+            return node
+
+    return None
+
+
+def is_exact_field(mappings, field):
+    mapping = field_mapping(mappings, field)
+    if not mapping:
+        return False
+
+    if mapping.get('type') in EXACT_TYPES:
+        return True
+
+    if mapping.get('type') == 'string' and mapping.get('index') == 'not_analyzed':
+        return True
+
+    # text with a keyword sub field
+    return any(it.get('type') in EXACT_TYPES for it in mapping.get('fields', {}).values())
+
+
 class ESBackend(Base):
     _ES_OP = ['create', 'update', 'upsert', 'delete']
+    # under the default 100MB `http.max_content_length`, sizes are estimates
+    max_flush_bytes = 64*1024*1024
 
     @classmethod
     def get_dataset(cls, ds, define=False):
@@ -46,7 +93,12 @@ class ESBackend(Base):
 
     @classmethod
     def get_collections(cls, match=''):
-        return ES.api.indices.get_alias(match, ignore_unavailable=True)
+        return catalog.get(('collections', match),
+                           lambda: ES.api.indices.get_alias(match, ignore_unavailable=True))
+
+    @classmethod
+    def refresh_catalog(cls, ns=None, name=None):
+        catalog.refresh()
 
     @classmethod
     def get_aliases(cls, match=''):
@@ -74,6 +126,9 @@ class ESBackend(Base):
     def __init__(self, params, job_log=None):
         self.define_op(params, 'asstr', 'mapping', allow_missing=True)
         self.define_op(params, 'asbool', 'mapping_update', default=False)
+        self.define_op(params, 'asint', 'bulk_workers', default=1)
+        self.define_op(params, 'asint', 'bulk_size', default=500)
+        self.define_op(params, 'asbool', 'bulk_compress', default=False)
 
         if params.mapping_update and not params.get('mapping'):
             raise ValueError('mapping must be supplied with mapping_update flag')
@@ -88,7 +143,13 @@ class ESBackend(Base):
 
         self.process_mapping()
 
+        self.bulk_writer = BulkWriter(ES.api, workers=self.params.bulk_workers,
+                                      bulk_size=self.params.bulk_size, compress=self.params.bulk_compress)
+
     def log_action(self, data, index, pk, action):
+        if not self.should_log_action(action, log):
+            return
+
         msg = '%s with %s(pk=%s)\n%s' % (action.upper(), index, pk, self.format4logging(data=data))
         if self.params.dry_run:
             log.warning('DRY RUN: %s' % msg)
@@ -100,6 +161,9 @@ class ESBackend(Base):
 
         index = self.process_index(data)
 
+        if self._use_pk_filter and self.skip_known('%s/%s' % (index, pk_val)):
+            return
+
         data = self.pre_save(data)
 
         if self.params.remove_fields:
@@ -117,6 +181,66 @@ class ESBackend(Base):
         index = self.process_index(data)
         self.add_to_buffer(index, data)
 
+    def count_target(self):
+        return ES.api.count(index=self.klass.index)['count']
+
+    def iter_target_keys(self):
+        # `_id`s are unique per index, an alias can span several
+        for hit in helpers.scan(ES.api, index=self.klass.index, query={'_source': False}, size=5000):
+            yield '%s/%s' % (hit['_index'], hit['_id'])
+
+    def op_fields(self):
+        return [it for it in self.params.op_params if it not in ['id', '_id']]
+
+    def op_index_status(self):
+        '''
+            `op_params` values make the doc `_id`, but lookups and joins on them only match exact values
+            when the fields are not analyzed.
+        '''
+        try:
+            mappings = ES.api.indices.get_mapping(index=self.klass.index)
+        except NotFoundError:
+            # dry runs do not create it
+            return False, 'index `%s` is missing' % self.klass.index
+
+        not_exact = []
+        for field in self.op_fields():
+            for index_mapping in mappings.values():
+                if not is_exact_field(index_mapping.get('mappings', {}), field):
+                    not_exact.append(field)
+                    break
+
+        if not not_exact:
+            return True, None
+
+        return False, '%s not mapped as keyword, term lookups will miss or scan' % not_exact
+
+    def create_op_index(self):
+        mappings = ES.api.indices.get_mapping(index=self.klass.index)
+        fields = [it for it in self.op_fields()
+                    if not all(field_mapping(it_map.get('mappings', {}), it) for it_map in mappings.values())]
+
+        if len(fields) < len(self.op_fields()):
+            log.warning('Analyzed fields can not be remapped in place, reindex `%s` to make them keyword',
+                            self.klass.index)
+        if not fields:
+            return
+
+        properties = {}
+        for field in fields:
+            node = properties
+            parts = field.split('.')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {}).setdefault('properties', {})
+            node[parts[-1]] = {'type': 'keyword'}
+
+        kw = dict(index=self.klass.index, body={'properties': properties})
+        if ES.version.major < 7:
+            kw['doc_type'] = self.params.doc_type
+
+        ES.api.indices.put_mapping(**kw)
+        log.info('Mapped %s of `%s` as keyword', fields, self.klass.index)
+
     def process_mapping(self):
 
         def set_default_mapping():
@@ -154,7 +278,26 @@ class ESBackend(Base):
             'transient':{'indices.store.throttle.type' : 'none'}})
 
     def flush(self, data, **kw):
-        return ES.flush(data)
+        success, all_errors = self.bulk_writer.bulk(data)
+        errors = []
+        retry_ids = set()
+
+        for err in all_errors:
+            info = next(iter(err.values()))
+            if info.get('status') in RETRY_STATUSES:
+                retry_ids.add(info.get('_id'))
+            else:
+                errors.append(err)
+
+        retries = [it for it in data if it.get('_id') in retry_ids] if retry_ids else []
+
+        log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s',
+                                len(data), success, len(errors), len(retries))
+        return success, errors, retries
+
+    def shutdown_flushes(self):
+        super().shutdown_flushes()
+        self.bulk_writer.close()
 
     def raise_or_log(self, data_size, errors):
 
@@ -198,26 +341,27 @@ class ESBackend(Base):
                 if target index is actually an index, use it.
         '''
 
-        #pop incoming meta from data first. not the best place, but we need the `_index`.
+        with self.metrics.timer('process_index'):
+            #pop incoming meta from data first. not the best place, but we need the `_index`.
 
-        #if _id is used to update, keep it
-        if '_id' not in self.params.pk:
-            data.pop('_id', None)
+            #if _id is used to update, keep it
+            if '_id' not in self.params.pk:
+                data.pop('_id', None)
 
-        data.pop('_type', None)
+            data.pop('_type', None)
 
-        data_index = data.pop('_index', None)
-        index = self.klass.index
+            data_index = data.pop('_index', None)
+            index = self.klass.index
 
-        #target is an alias ?
-        if index in self.klass.alias_map:
-            if data_index and data_index in self.klass.index_map:
-                index = data_index
-            else:
-                raise ValueError('Target is an alias that does not contain the incoming data index.'
-                                 '\nTarget index: `%s`\nData index: `%s`' % (self.klass.alias_map, data_index))
+            #target is an alias ?
+            if index in self.klass.alias_map:
+                if data_index and data_index in self.klass.index_map:
+                    index = data_index
+                else:
+                    raise ValueError('Target is an alias that does not contain the incoming data index.'
+                                     '\nTarget index: `%s`\nData index: `%s`' % (self.klass.alias_map, data_index))
 
-        return index
+            return index
 
     def add_to_buffer(self, index, data, pk_val=None):
         if not pk_val:
@@ -259,8 +403,7 @@ class ESBackend(Base):
         else:
             raise ValueError('Bad op %s' % self.params.op)
 
-        with self._buffer_lock:
-            self._buffer.append(action)
+        self.buffer_append(action)
 
         self.log_action(data, index, pk_val, self.params.op)
 
@@ -287,6 +430,8 @@ class ESBackend(Base):
                 if 'index_already_exists_exception' not in e.error:
                     raise e
 
+            catalog.refresh()
+
         meta = ES.get_meta(ds.index)
         if not meta.get('mapping'):
             ES.put_mapping(index = ds.index,
@@ -309,8 +454,10 @@ class ESBackend(Base):
     def drop_index(cls, params):
         ds = cls.get_dataset(params)
         ES.api.indices.delete(index=ds.index, ignore=[400, 404])
+        catalog.refresh()
 
     @classmethod
     def drop_namespace(cls, name):
         ES.api.indices.delete(index='%s.*' % name, ignore=[400, 404])
+        catalog.refresh()
 
@@ -1,7 +1,10 @@
 from types import ModuleType
+import asyncio
 import re
 import sys
 import logging
+import time
+from threading import Lock, Event
 
 import mongoengine as mongo
 from datetime import datetime
@@ -9,52 +12,100 @@ from bson import ObjectId
 import datetime
 from pprint import pformat
 
+from pymongo import UpdateOne, UpdateMany, DeleteMany
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+from mongoengine.queryset import transform
 from slovar import slovar
 import prf
-from prf.mongodb import DynamicBase, mongo_connect, mongo_disconnect, drop_db
-from prf.utils import maybe_dotted, typecast, str2dt, to_dunders
+from prf.mongodb import DynamicBase, mongo_disconnect, drop_db
+from prf.utils import maybe_dotted, typecast, str2dt, to_dunders, parse_specials, Params
 
 import datasets
+from datasets.catalog import Catalog
+from datasets.reader import MongoReader
+from datasets.checkpoint import build_checkpoints
 
 log = logging.getLogger(__name__)
 
+# write errors worth retrying: node down or stepping down, network, write concern, throttling
+RETRYABLE_CODES = frozenset([6, 7, 64, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436, 16500])
+
+WRITE_OPS = (UpdateOne, UpdateMany, DeleteMany)
+
+EMPTY_BULK_RESULT = {'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'nRemoved': 0, 'writeErrors': []}
+
+# one client (and connection pool) per cluster, shared by the namespace aliases
+_clients = {}
+_clients_lock = Lock()
+
+# database and collection names, indexes and stats, see `refresh_catalog`
+catalog = Catalog()
+
+# document classes by (ns, name), reused across get_dataset calls until invalidated
+_documents = {}
+_documents_lock = Lock()
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
 import datasets
-from datasets.backends.base import Base
+from datasets.backends.base import Base, payload_size
 
 
 class MONGOBackend(Base):
+    # under the 48MB server message limit, sizes are estimates
+    max_flush_bytes = 32*1024*1024
 
     def __init__(self, params, job_log=None):
+        self.define_op(params, 'asbool', 'bulk_write', default=False)
+        self.define_op(params, 'asbool', 'raw_create', default=False)
+        self.define_op(params, 'asbool', 'prefetch_targets', default=True)
         super().__init__(params, job_log)
 
     @classmethod
     def get_dataset(cls, ds, define=False):
         ds = cls.process_ds(ds)
+        return registered_document(ds.ns, ds.name, define=define)
 
-        if define:
-            _raise = False
-
-        connect_namespace(datasets.Settings, ds.ns)
-        kls = define_document(ds.name, namespace=ds.ns, redefine=define)
-        set_document(ds.ns, ds.name, kls)
-
-        return kls
+    @classmethod
+    def get_reader(cls, ds, **kw):
+        '''
+            Parallel `_id` range reader of `ds`, see `datasets.reader.MongoReader` for `kw`.
+        '''
+        return MongoReader(cls.get_dataset(ds)._get_collection(), **kw)
 
     @classmethod
     def get_meta(cls, ns, name):
         return get_dataset_meta(ns, name)
 
+    @classmethod
+    def get_stats(cls, ns, name):
+        return get_dataset_stats(ns, name)
+
+    @classmethod
+    def refresh_catalog(cls, ns=None, name=None):
+        refresh_catalog(ns, name)
+
     @classmethod
     def drop_dataset(cls, ds):
         ds = cls.get_dataset(ds)
         if ds:
             ds.drop_collection()
+            invalidate_documents(ds._ns, ds.__name__)
+            refresh_catalog(ds._ns, ds.__name__)
 
     @classmethod
     def drop_namespace(cls, ns):
         drop_db(ns)
+        invalidate_documents(ns)
+        refresh_catalog(ns)
 
     def log_action(self, data, query, action):
+        if not self.should_log_action(action, log):
+            return
+
         if action in ['create']:
             with_arg = 'with pk=%s' % (data.extract(self.params.pk) if self.params.get('pk') else None)
         else:
@@ -67,22 +118,336 @@ class MONGOBackend(Base):
             log.debug(msg)
 
     def add_to_buffer(self, data):
+        if self.params.raw_create:
+            return self.add_raw_to_buffer(data)
+
         obj = self.klass()
 
         for name, val in list(data.items()):
             setattr(obj, name, val)
 
-        with self._buffer_lock:
-            self._buffer.append(obj)
+        self.buffer_append(obj, data)
 
         return obj
 
+    def add_raw_to_buffer(self, data):
+        '''
+            `raw_create` counterpart of `add_to_buffer`: a plain dict goes straight to the pymongo collection,
+            no Document is built. Only `id` is mapped, to `_id`, as an ObjectId when it is a valid one
+            and as is otherwise, like `ObjectIdField` does.
+        '''
+        doc = dict(data)
+
+        if 'id' in doc:
+            _id = doc.pop('id')
+            doc['_id'] = ObjectId(_id) if not isinstance(_id, ObjectId) and ObjectId.is_valid(_id) else _id
+
+        self.buffer_append(doc, data)
+
+        return doc
+
+    def count_target(self):
+        return self.klass._get_collection().estimated_document_count()
+
+    def iter_target_keys(self):
+        fields = ['_id' if it == 'id' else it for it in self.params.skip_by]
+        projection = dict.fromkeys(fields, 1)
+        projection.setdefault('_id', 0)
+
+        for doc in self.klass._get_collection().find({}, projection).batch_size(10000):
+            doc = slovar(doc)
+            if '_id' in doc:
+                doc['id'] = doc.pop('_id')
+            yield self.skip_key(doc)
+
+    def op_index_status(self):
+        fields = self.target_fields()
+        if fields == ['_id']:
+            return True, None
+
+        collection = self.klass._get_collection()
+        for index in collection.index_information().values():
+            # an index whose leading field is looked up narrows the scan to its matches
+            if index['key'][0][0] in fields:
+                return True, None
+
+        return False, 'every record scans ~%s documents' % collection.estimated_document_count()
+
+    def create_op_index(self):
+        fields = self.target_fields()
+        name = self.klass._get_collection().create_index([(it, 1) for it in fields], background=True)
+
+        log.info('Created index `%s` on `%s.%s`', name, self.klass._ns, self.params.name)
+        refresh_catalog(self.klass._ns, self.params.name)
+
+    def can_prepare_in_workers(self):
+        #update, upsert and delete query the collection while processing, unless they are buffered
+        return super().can_prepare_in_workers() and (self.params.op == 'create' or self.params.bulk_write)
+
+    def item_size(self, obj):
+        if isinstance(obj, mongo.Document):
+            return payload_size(obj._data)
+        if isinstance(obj, WRITE_OPS):
+            return payload_size(obj._filter) + payload_size(getattr(obj, '_doc', None))
+        return payload_size(obj)
+
+    def export_buffer_item(self, obj):
+        if isinstance(obj, mongo.Document):
+            return obj.to_mongo()
+        return obj
+
     def flush(self, objs, **kw):
-        success, errors = self.klass.insert_many(objs, fail_on_error=False)
+        try:
+            if objs and isinstance(objs[0], WRITE_OPS):
+                success, errors = self.write_ops(objs)
+            elif objs and not isinstance(objs[0], mongo.Document):
+                success, errors = self.insert_raw(objs)
+            else:
+                success, errors = self.klass.insert_many(objs, fail_on_error=False)
+        except ConnectionFailure as e:
+            log.warning('BULK FLUSH of %s docs failed, will retry: %r', len(objs), e)
+            return 0, [], list(objs)
+
+        errors, retries = self.split_retries(objs, errors)
+        log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s',
+                                            len(objs), success, len(errors), len(retries))
+
+        return success, errors, retries
+
+    def split_retries(self, objs, errors):
+        '''
+            Separate the write errors worth retrying. Returns `(errors, retries)`, retries being the failed `objs`.
+        '''
+        if not errors:
+            return errors, []
+
+        permanent = []
+        retries = []
+        for err in errors:
+            if err.get('code') in RETRYABLE_CODES and 'index' in err:
+                retries.append(objs[err['index']])
+            else:
+                permanent.append(err)
+
+        return permanent, retries
+
+    def insert_raw(self, docs):
+        try:
+            result = self.klass._get_collection().insert_many(docs, ordered=False)
+            return len(result.inserted_ids), []
+        except BulkWriteError as e:
+            return e.details['nInserted'], e.details['writeErrors']
+
+    def write_ops(self, ops):
+        writes, indexes, errors = self.match_targets(ops, self.target_counts(ops))
+        if not writes:
+            return self.bulk_status(ops, EMPTY_BULK_RESULT, indexes, errors)
+
+        try:
+            result = self.klass._get_collection().bulk_write(writes, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+
+        return self.bulk_status(ops, result, indexes, errors)
+
+    def bulk_status(self, ops, result, indexes=None, errors=()):
+        '''
+            `(success, errors)` for `ops`. `indexes` are the positions in `ops` of the operations written,
+            when some were left out by `match_targets` with `errors`.
+        '''
+        log.debug('%s status: matched=%s, modified=%s, upserted=%s, removed=%s', self.params.op,
+                    result['nMatched'], result['nModified'], result['nUpserted'], result['nRemoved'])
+
+        write_errors = result['writeErrors']
+        if indexes is not None:
+            for err in write_errors:
+                err['index'] = indexes[err['index']]
+
+        errors = list(errors) + write_errors
+        return len(ops) - len(errors), errors
+
+    def target_fields(self):
+        return ['_id' if it == 'id' else it for it in self.params.op_params]
+
+    def targets_query(self, ops):
+        '''
+            `(query, projection)` to fetch the documents matched by a chunk of `bulk_write` ops in one
+            round trip, or None when there is nothing to check or the filters can not be matched locally.
+        '''
+        if not self.params.prefetch_targets:
+            return None
+
+        if self.params.op != 'delete' and self.params.update_multi:
+            return None
+
+        fields = self.target_fields()
+        filters = [op._filter for op in ops]
+
+        for flt in filters:
+            for field in fields:
+                if field not in flt or isinstance(flt[field], (dict, list)):
+                    return None
+
+        projection = dict.fromkeys(fields, 1)
+        projection['_id'] = 1
+
+        if len(fields) == 1 and all(len(flt) == 1 for flt in filters):
+            query = {fields[0]: {'$in': list({flt[fields[0]] for flt in filters})}}
+        else:
+            query = {'$or': filters}
+
+        return query, projection
+
+    def needs_match_check(self):
+        return self.params.op == 'delete' or not self.params.update_multi
+
+    def target_counts(self, ops):
+        '''
+            Number of documents (up to 2) each of `ops` matches, from one fetch of the chunk targets
+            when possible, one count per op otherwise. None when there is nothing to check.
+        '''
+        if not self.needs_match_check():
+            return None
+
+        collection = self.klass._get_collection()
+
+        query = self.targets_query(ops)
+        if query:
+            counts = self.match_counts(ops, collection.find(*query))
+            if counts is not None:
+                return counts
+
+        return [collection.count_documents(op._filter, limit=2) for op in ops]
+
+    def match_counts(self, ops, targets):
+        '''
+            Number of `targets` matched by each of `ops`, None when they can not be matched locally.
+        '''
+        fields = self.target_fields()
+
+        matches = {}
+        for doc in targets:
+            key = tuple(nested_value(doc, field) for field in fields)
+            try:
+                matches[key] = matches.get(key, 0) + 1
+            except TypeError:
+                # array field, a scalar filter matches any of its elements
+                return None
+
+        return [matches.get(tuple(op._filter[field] for field in fields), 0) for op in ops]
+
+    def match_targets(self, ops, counts):
+        '''
+            Check `ops` against the `counts` of documents they match: without `update_multi` an update matching
+            several documents is an error, and updates or deletes matching nothing are not sent.
+            Returns `(writes, indexes, errors)`, `indexes` being the positions of `writes` in `ops`.
+        '''
+        if counts is None:
+            return ops, None, []
+
+        writes = []
+        indexes = []
+        errors = []
+
+        for ix, op in enumerate(ops):
+            nb_matches = counts[ix]
+
+            if nb_matches > 1 and not self.params.update_multi and self.params.op != 'delete':
+                msg = 'Multiple (%s) updates for\n%s' % (nb_matches, self.format4logging(query=op._filter))
+                log.warning(msg)
+                errors.append({'index': ix, 'code': 'multiple', 'errmsg': msg, 'op': op._filter})
+                continue
+
+            if not nb_matches and not getattr(op, '_upsert', False):
+                if self.params.op == 'delete':
+                    self.log_not_found(op._filter, {})
+                continue
+
+            writes.append(op)
+            indexes.append(ix)
+
+        return writes, indexes, errors
+
+    async def aflush(self, objs):
+        if not AsyncIOMotorClient:
+            return await super().aflush(objs)
+
+        try:
+            if objs and isinstance(objs[0], WRITE_OPS):
+                success, errors = await self.awrite_ops(objs)
+            else:
+                docs = [it.to_mongo() if isinstance(it, mongo.Document) else it for it in objs]
+                result = await self.motor_collection().insert_many(docs, ordered=False)
+                success, errors = len(result.inserted_ids), []
+
+        except BulkWriteError as e:
+            success, errors = e.details['nInserted'], e.details['writeErrors']
+        except ConnectionFailure as e:
+            log.warning('BULK FLUSH of %s docs failed, will retry: %r', len(objs), e)
+            return 0, [], list(objs)
+
+        errors, retries = self.split_retries(objs, errors)
         log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s',
-                                            len(objs), success, len(errors), 0)
+                                            len(objs), success, len(errors), len(retries))
+
+        return success, errors, retries
+
+    async def awrite_ops(self, ops):
+        writes, indexes, errors = self.match_targets(ops, await self.atarget_counts(ops))
+        if not writes:
+            return self.bulk_status(ops, EMPTY_BULK_RESULT, indexes, errors)
+
+        try:
+            result = (await self.motor_collection().bulk_write(writes, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+
+        return self.bulk_status(ops, result, indexes, errors)
+
+    async def atarget_counts(self, ops):
+        if not self.needs_match_check():
+            return None
+
+        collection = self.motor_collection()
 
-        return success, errors, 0
+        query = self.targets_query(ops)
+        if query:
+            counts = self.match_counts(ops, await collection.find(*query).to_list(None))
+            if counts is not None:
+                return counts
+
+        return [await collection.count_documents(op._filter, limit=2) for op in ops]
+
+    def motor_collection(self):
+        #motor clients are bound to the loop they were created on
+        loop = asyncio.get_event_loop()
+        if getattr(self, '_motor_loop', None) is not loop:
+            self.close_motor_client()
+            self._motor_client = AsyncIOMotorClient(
+                datasets.Settings.get('mongodb.host', 'localhost'),
+                datasets.Settings.asint('mongodb.port', default=27017),
+                io_loop=loop, **client_options(datasets.Settings))
+            self._motor_loop = loop
+
+        return self._motor_client[self.klass._ns][self.klass._get_collection_name()]
+
+    def close_motor_client(self):
+        client = getattr(self, '_motor_client', None)
+        if client is not None:
+            client.close()
+        self._motor_client = None
+        self._motor_loop = None
+
+    def shutdown_flushes(self):
+        super().shutdown_flushes()
+        self.close_motor_client()
+
+    def end_job(self):
+        super().end_job()
+
+        if not self.params.dry_run:
+            # the job may have created the collection or its indexes, and its stats changed
+            refresh_catalog(self.klass._ns, self.params.name)
 
     def raise_or_log(self, data_size, errors):
 
@@ -120,6 +485,10 @@ class MONGOBackend(Base):
                 obj.save_safe()
 
     def create(self, data):
+        # before `pre_save`, so skipped records cost no job log
+        if self._use_pk_filter and self.skip_known(self.skip_key(data)):
+            return
+
         data = self.pre_save(data)
         self.add_to_buffer(data)
         self.log_action(data, None, 'create')
@@ -146,12 +515,25 @@ class MONGOBackend(Base):
             if not self.params.update_multi:
                 raise ValueError(msg)
 
+        update_dct = self.build_update(data)
+        if not update_dct:
+            return
+
+        action = ('upsert' if upsert else 'update')
+
+        if not self.params.dry_run:
+            status = objects.update(upsert=upsert, full_result=True, **update_dct)
+            log.debug('%s status: %s', action, status.raw_result)
+
+        self.log_action(update_dct, qparams, action)
+
+    def build_update(self, data):
         data = self.pre_save(data)
         data.pop('id', None);data.pop('_id', None)
 
         if not data:
             log.debug('NOTHING TO UPDATE')
-            return
+            return None
 
         update_dct = slovar()
 
@@ -160,25 +542,51 @@ class MONGOBackend(Base):
             update_dct['unset__%s' % rf] = 1
 
         update_dct.update(to_dunders(data))
+        return update_dct
+
+    def buffer_update(self, data, upsert=False):
+        '''
+            `bulk_write` counterpart of `update_objects`: the update is buffered as a pymongo operation
+            instead of querying and updating the matches right away.
+            Matches are checked when the chunk is written, see `match_targets`.
+        '''
+        qparams = self.build_query(self.params.op_params, data)
+
+        update_dct = self.build_update(data)
+        if not update_dct:
+            return
 
-        action = ('upsert' if upsert else 'update')
+        op_class = UpdateMany if self.params.update_multi else UpdateOne
+        self.buffer_append(op_class(self.build_filter(qparams),
+                                    transform.update(self.klass, **update_dct), upsert=upsert), update_dct)
 
-        if not self.params.dry_run:
-            objects.update(upsert=upsert, **update_dct)
-            status = self.klass.get_last_status()
-            log.debug('%s status: %s', action, status)
+        self.log_action(update_dct, qparams, 'upsert' if upsert else 'update')
 
-        self.log_action(update_dct, qparams, action)
+    def build_filter(self, qparams):
+        params, _ = parse_specials(Params(qparams.flat()))
+        return transform.query(self.klass, **params)
 
     def update(self, data):
+        if self.params.bulk_write:
+            return self.buffer_update(data)
+
         qparams, objects = self.get_objects(self.params.op_params, data)
         self.update_objects(objects, data, qparams)
 
     def upsert(self, data):
+        if self.params.bulk_write:
+            return self.buffer_update(data, upsert=True)
+
         qparams, objects = self.get_objects(self.params.op_params, data)
         self.update_objects(objects, data, qparams, upsert=True)
 
     def delete(self, data):
+        if self.params.bulk_write:
+            params = self.build_query(self.params.op_params, data)
+            self.buffer_append(DeleteMany(self.build_filter(params)), data)
+            self.log_action(data, params, 'delete')
+            return
+
         params, objects = self.get_objects(self.params.op_params, data)
 
         if not objects:
@@ -211,16 +619,31 @@ class MONGOBackend(Base):
         query['_limit'] = -1
         return query
 
-    def get_objects(self, keys, data):
+    def build_query(self, keys, data):
         _params = self.build_query_params(data, keys)
         if 'query' in self.params:
             _params = _params.update_with(typecast(self.params.query))
 
+        return _params
+
+    def get_objects(self, keys, data):
+        _params = self.build_query(keys, data)
         return _params, self.klass.get_collection(**_params.flat())
 
 
+def nested_value(doc, path):
+    for name in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(name)
+
+    return doc
+
+
 def includeme(config):
     datasets.Settings = slovar(config.registry.settings)
+    catalog.ttl = datasets.Settings.asfloat('dataset.catalog_ttl', default=60)
+    catalog.max_workers = datasets.Settings.asint('dataset.catalog_workers', default=16)
 
 class DSDocumentBase(DynamicBase):
     meta = {'abstract': True}
@@ -230,6 +653,7 @@ class DSDocumentBase(DynamicBase):
     def unregister(cls):
         super(DSDocumentBase, cls).unregister()
         unset_document(cls)
+        invalidate_documents(cls._ns, cls.__name__)
 
     @classmethod
     def drop_ds(cls):
@@ -250,12 +674,79 @@ class DatasetStorageModule(ModuleType):
         return cls
 
 
+def mongoengine_registry(name):
+    '''
+        mongoengine's private `connection._connections` (`{alias: client}`) or `connection._connection_settings`.
+        There is no public API to register an existing client under an alias, this is the only place reaching in,
+        so a mongoengine upgrade that changes them fails here instead of quietly reconnecting every namespace.
+    '''
+    registry = getattr(mongo.connection, name, None)
+    if not isinstance(registry, dict):
+        raise RuntimeError('mongoengine %s has no `connection.%s` registry, namespace clients can not be shared'
+                                % (getattr(mongo, '__version__', '?'), name))
+    return registry
+
+
+def is_connected(namespace):
+    return namespace in mongoengine_registry('_connection_settings')
+
+
 def connect_namespace(settings, namespace):
-    connect_settings = settings.update({
-        'mongodb.alias': namespace,
-        'mongodb.db': namespace
-    })
-    mongo_connect(connect_settings)
+    '''
+        Register the `namespace` alias on the client shared by all namespaces of the same host,
+        instead of a client and pool per namespace.
+    '''
+    if is_connected(namespace) and namespace in mongoengine_registry('_connections'):
+        return
+
+    settings = slovar(settings)
+    host = settings.get('mongodb.host', 'localhost')
+    port = settings.asint('mongodb.port', default=27017)
+
+    mongo.connection.register_connection(namespace, db=namespace, host=host, port=port)
+    mongoengine_registry('_connections')[namespace] = shared_client(settings, host, port)
+
+    log.debug('MongoDB namespace %s on shared client %s:%s', namespace, host, port)
+
+
+def client_options(settings):
+    '''
+        Pool options from `mongodb.max_pool_size`, `mongodb.min_pool_size` and `mongodb.max_idle_time_ms`.
+    '''
+    options = {}
+    for name, option in [('max_pool_size', 'maxPoolSize'), ('min_pool_size', 'minPoolSize'),
+                         ('max_idle_time_ms', 'maxIdleTimeMS')]:
+        if settings.get('mongodb.%s' % name) is not None:
+            options[option] = settings.asint('mongodb.%s' % name)
+
+    return options
+
+
+def shared_client(settings, host, port):
+    options = client_options(settings)
+    key = (host, port, tuple(sorted(options.items())))
+
+    with _clients_lock:
+        client = _clients.get(key)
+
+        # mongoengine closes a client when its last alias is disconnected
+        if client is None or not any(client is it for it in mongoengine_registry('_connections').values()):
+            client = mongo.connection.MongoClient(host, port, connect=False, **options)
+            _clients[key] = client
+
+    return client
+
+
+def disconnect_namespace(namespace):
+    '''
+        Drop the `namespace` alias. The shared client stays open for the other namespaces.
+    '''
+    connections = mongoengine_registry('_connections')
+    client = connections.pop(namespace, None)
+    mongo_disconnect(namespace)
+
+    if client is not None and not any(client is it for it in connections.values()):
+        client.close()
 
 
 def registered_namespaces(settings):
@@ -263,7 +754,7 @@ def registered_namespaces(settings):
         or settings.aslist('dataset.ns', '') \
 
     if ns[0] == '*':
-        return mongo.connection.get_connection().database_names()
+        return list_databases()
 
     else:
         return ns
@@ -273,7 +764,7 @@ def connect_dataset_aliases(settings, aliases=None, reconnect=False):
     aliases = aliases or registered_namespaces(settings)
     for alias in aliases:
         if reconnect:
-            mongo_disconnect(alias)
+            disconnect_namespace(alias)
         connect_namespace(settings, alias)
 
 
@@ -281,27 +772,58 @@ def get_dataset_names(match_name="", match_namespace=""):
     """
     Get dataset names, matching `match` pattern if supplied, restricted to `only_namespace` if supplied
     """
-    namespaces = get_namespaces()
+    namespaces = [ns for ns in get_namespaces() if not match_namespace or match_namespace == ns]
+    collections = list_collections(namespaces)
+
     names = []
     for namespace in namespaces:
-        if match_namespace and match_namespace == namespace or not match_namespace:
-            db = mongo.connection.get_db(namespace)
-            for name in db.collection_names():
-                if match_name in name.lower() and not name.startswith('system.'):
-                    names.append([namespace, name, name])
+        for name in collections[namespace]:
+            if match_name in name.lower() and not name.startswith('system.'):
+                names.append([namespace, name, name])
     return names
 
 
+def list_databases():
+    return catalog.get(('databases',), lambda: mongo.connection.get_connection().list_database_names())
+
+
+def list_collections(namespaces):
+    '''
+        `{namespace: [collection names]}`, the namespaces not in the catalog are listed concurrently.
+    '''
+    def fetch(key):
+        return mongo.connection.get_db(key[1]).list_collection_names()
+
+    names = catalog.get_many([('names', ns) for ns in namespaces], fetch)
+    return {key[1]: value for key, value in names.items()}
+
+
+def refresh_catalog(ns=None, name=None):
+    '''
+        Drop the cached names, indexes and stats of `ns` (and `name`), everything if no `ns`.
+    '''
+    if not ns:
+        catalog.refresh()
+        return
+
+    catalog.refresh('databases')
+    catalog.refresh('names', ns)
+
+    for kind in ['indexes', 'stats']:
+        if name:
+            catalog.refresh(kind, ns, name)
+        else:
+            catalog.refresh(kind, ns)
+
+
 def get_namespaces():
     # Mongoengine stores connections as a dict {alias: connection}
     # Getting the keys is the list of aliases (or namespaces) we're connected to
-    return list(mongo.connection._connections.keys())
+    return list(mongoengine_registry('_connections').keys())
 
 
 def get_dataset_meta(namespace, doc_name):
-    db = mongo.connection.get_db(namespace)
-
-    if doc_name not in db.collection_names():
+    if doc_name not in list_collections([namespace])[namespace]:
         return slovar()
 
     meta = slovar(
@@ -310,8 +832,11 @@ def get_dataset_meta(namespace, doc_name):
         db_alias=namespace,
     )
 
+    index_info = catalog.get(('indexes', namespace, doc_name),
+                        lambda: mongo.connection.get_db(namespace)[doc_name].index_information())
+
     indexes = []
-    for ix_name, index in list(db[doc_name].index_information().items()):
+    for ix_name, index in list(index_info.items()):
         fields = [
             '%s%s' % (('-' if order == -1 else ''), doc_name)
             for (doc_name, order) in index['key']
@@ -328,6 +853,11 @@ def get_dataset_meta(namespace, doc_name):
     return meta
 
 
+def get_dataset_stats(namespace, doc_name):
+    return catalog.get(('stats', namespace, doc_name),
+                       lambda: slovar(mongo.connection.get_db(namespace).command('collstats', doc_name)))
+
+
 # TODO Check how this method is used and see if it can call set_document
 def define_document(name, meta=None, namespace='default', redefine=False,
                     base_class=None):
@@ -361,13 +891,7 @@ def define_document(name, meta=None, namespace='default', redefine=False,
 
 def define_datasets(namespace):
     connect_namespace(datasets.Settings, namespace)
-    db = mongo.connection.get_db(namespace)
-
-    dsets = []
-    for name in db.collection_names():
-        dsets.append(name)
-
-    return dsets
+    return list(list_collections([namespace])[namespace])
 
 
 def load_documents():
@@ -442,11 +966,258 @@ def get_mongo_dataset(name, ns=None, define=False):
     if not ns:
         ns, _, name = name.rpartition('.')
 
-    if define:
-        _raise = False
+    return registered_document(ns, name, define=define)
+
 
-    connect_namespace(datasets.Settings, ns)
-    kls = define_document(name, namespace=ns, redefine=define)
-    set_document(ns, name, kls)
+def registered_document(ns, name, define=False):
+    '''
+        Document class for `ns.name` from the registry. It is defined, and the namespace connected,
+        on first use or when the namespace was disconnected since.
+    '''
+    key = (ns, name)
+
+    kls = _documents.get(key)
+    if kls is not None and is_connected(ns):
+        return kls
+
+    with _documents_lock:
+        kls = _documents.get(key)
+        if kls is not None and is_connected(ns):
+            return kls
+
+        if not is_connected(ns):
+            connect_namespace(datasets.Settings, ns)
+
+        kls = define_document(name, namespace=ns, redefine=define or kls is not None)
+        set_document(ns, name, kls)
+        _documents[key] = kls
 
     return kls
+
+
+def invalidate_documents(ns=None, name=None):
+    '''
+        Forget the registered document classes, of `ns` or of `ns.name` only, or all of them.
+    '''
+    with _documents_lock:
+        for key in list(_documents):
+            if ns is None or (key[0] == ns and (name is None or key[1] == name)):
+                # so the next `define_document` builds a new class
+                unset_document(_documents.pop(key))
+
+
+class ChangeSource(object):
+    '''
+        Incremental copy of the `ds` collection into the `target` backend params (without `op`).
+        Tails the collection change stream, or polls for documents with a newer `updated_at` when change streams
+        are not available (standalone servers) or `mode=poll`. Polling does not see deletes.
+
+        Events are applied in batches of up to `batch_size` records, or what came in `batch_timeout` seconds:
+        inserts, updates and replaces are `upsert`ed and deletes `delete`d by `pk` in the target,
+        one backend job per run of the same op, in event order. The target backend of each op is built once.
+        With `checkpoint` (see `datasets.checkpoint.build_checkpoints`), the resume token or the last polled
+        `updated_at` is saved after every batch under `job_id`, and a restart continues from there,
+        replaying at most the last batch: upserts make that harmless.
+        Delete events only carry the source `_id`, so change streams need `pk=id`. Other pks are polled.
+    '''
+    MODES = ['auto', 'stream', 'poll']
+
+    def __init__(self, ds, target, pk='id', mode='auto', batch_size=1000, batch_timeout=1.0,
+                 poll_interval=5.0, checkpoint=None, job_id=None, job_log=None):
+        if mode not in self.MODES:
+            raise ValueError('`mode` must be one of %s, got `%s`' % (self.MODES, mode))
+
+        if checkpoint and not job_id:
+            raise ValueError('`checkpoint` needs a `job_id`')
+
+        if pk != 'id':
+            if mode == 'stream':
+                raise ValueError('`mode=stream` needs `pk=id`, delete events only carry the source `_id`')
+            mode = 'poll'
+
+        self.collection = MONGOBackend.get_dataset(ds)._get_collection()
+        self.target = slovar(target)
+        self.pk = pk
+        self.mode = mode
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.poll_interval = poll_interval
+        self.job_id = job_id
+        self.job_log = job_log or slovar()
+
+        self.checkpoints = build_checkpoints(checkpoint) if checkpoint else None
+        self.state = slovar(resume_token=None, updated_at=None, last_id=None)
+        self.stats = slovar(batches=0, records=0, success=0, errors=0)
+        self._stop = Event()
+        self._backends = {}
+
+        if self.checkpoints:
+            state = self.checkpoints.load(job_id)
+            if state:
+                self.state.update(state)
+                log.info('Resuming `%s` changes from %s', self.collection.name, self.checkpoints)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, until_idle=False):
+        '''
+            Apply changes until `stop()`, or until there is nothing new if `until_idle`.
+        '''
+        if self.mode != 'poll':
+            try:
+                return self.run_stream(until_idle)
+            except (OperationFailure, NotImplementedError) as e:
+                if self.mode == 'stream':
+                    raise
+                log.warning('No change stream on `%s` (%r), polling `updated_at` instead', self.collection.name, e)
+
+        return self.run_poll(until_idle)
+
+    def run_stream(self, until_idle=False):
+        kw = dict(full_document='updateLookup', max_await_time_ms=int(self.batch_timeout*1000))
+        if self.state.resume_token:
+            kw['resume_after'] = self.state.resume_token
+
+        with self.collection.watch(**kw) as stream:
+            while not self._stop.is_set():
+                events = []
+                deadline = time.monotonic() + self.batch_timeout
+
+                while len(events) < self.batch_size and time.monotonic() < deadline:
+                    event = stream.try_next()
+                    if event is None:
+                        break
+                    events.append(event)
+
+                if events:
+                    self.apply([self.event_change(it) for it in events])
+
+                # the token moves on idle batches too
+                if stream.resume_token and stream.resume_token != self.state.resume_token:
+                    self.state.resume_token = stream.resume_token
+                    self.save_state()
+
+                if not events and until_idle:
+                    break
+
+                if not stream.alive:
+                    log.warning('Change stream of `%s` was invalidated', self.collection.name)
+                    break
+
+        return self.stats
+
+    def event_change(self, event):
+        op_type = event['operationType']
+
+        if op_type == 'delete':
+            return 'delete', slovar({self.pk: event['documentKey']['_id']})
+
+        if op_type in ['insert', 'update', 'replace']:
+            doc = event.get('fullDocument')
+            if doc is None:
+                # deleted since, the delete event follows
+                return None
+            # a restart replays the last batch, inserts must not fail as duplicates
+            return 'upsert', self.to_record(doc)
+
+        log.warning('Ignoring `%s` event on `%s`', op_type, self.collection.name)
+        return None
+
+    def run_poll(self, until_idle=False):
+        while not self._stop.is_set():
+            docs = list(self.collection.find(self.poll_query())
+                            .sort([('updated_at', 1), ('_id', 1)])
+                            .limit(self.batch_size))
+
+            if docs:
+                self.apply([('upsert', self.to_record(it)) for it in docs])
+                self.state.updated_at = docs[-1].get('updated_at')
+                self.state.last_id = docs[-1]['_id']
+                self.save_state()
+
+            if len(docs) < self.batch_size:
+                if until_idle:
+                    break
+                self._stop.wait(self.poll_interval)
+
+        return self.stats
+
+    def poll_query(self):
+        last = self.state.updated_at
+        if last is None:
+            return {'updated_at': {'$exists': True}}
+
+        # file checkpoints keep them as strings
+        if isinstance(last, str):
+            last = str2dt(last)
+
+        last_id = self.state.last_id
+        if isinstance(last_id, str) and ObjectId.is_valid(last_id):
+            last_id = ObjectId(last_id)
+
+        # documents saved in the same instant are ordered by `_id`
+        return {'$or': [
+            {'updated_at': {'$gt': last}},
+            {'updated_at': last, '_id': {'$gt': last_id}},
+        ]}
+
+    def to_record(self, doc):
+        record = slovar(doc)
+        _id = record.pop('_id')
+        if self.pk == 'id':
+            record['id'] = _id
+        return record
+
+    def apply(self, changes):
+        '''
+            Run `changes`, `(op, record)` pairs, as one target job per run of the same op.
+        '''
+        run_op = None
+        records = []
+
+        for change in changes:
+            if change is None:
+                continue
+
+            op, record = change
+            if op != run_op and records:
+                self.apply_run(run_op, records)
+                records = []
+
+            run_op = op
+            records.append(record)
+
+        if records:
+            self.apply_run(run_op, records)
+
+        self.stats.batches += 1
+
+    def target_backend(self, op):
+        '''
+            Target backend for `op`, built once so its preflight and skip filter load run once too.
+        '''
+        backend = self._backends.get(op)
+        if backend is None:
+            params = self.target.update_with({'op': '%s:%s' % (op, self.pk)})
+            backend = self._backends[op] = datasets.name2be(params.backend)(params, self.job_log)
+
+        return backend
+
+    def apply_run(self, op, records):
+        backend = self.target_backend(op)
+
+        # backend counters add up across runs
+        before = backend.flush_stats.copy()
+        result = backend.process_many(records)
+
+        # the target only counts what goes through its write buffer
+        self.stats.records += len(records)
+        for name in ['success', 'errors']:
+            self.stats[name] += result.get(name, 0) - before.get(name, 0)
+
+        log.debug('%s %s changes of `%s`: %s', op, len(records), self.collection.name, result)
+
+    def save_state(self):
+        if self.checkpoints:
+            self.checkpoints.save(self.job_id, self.state)
@@ -25,11 +25,20 @@ def Bucket(name):
     return s3.Bucket(name)
 
 
+def part_key(path, part):
+    #first chunk keeps the dataset key, later ones go next to it
+    return '%s_part%05d' % (path, part) if part else path
+
+
 class S3Backend(Base):
+    #chunks are numbered parts of the same key
+    _ordered_flush = True
 
     def __init__(self, params, job_log):
         super().__init__(params, job_log)
 
+        self._part = 0
+
         fields = []
 
         if not self.params.get('fields'):
@@ -96,14 +105,13 @@ class S3Backend(Base):
         return S3(Base.process_ds(ds), create=define)
 
     def create(self, data):
-        with self._buffer_lock:
-            self._buffer.append(data)
+        self.buffer_append(data)
 
     def flush(self, objs):
         s3 = boto3.resource('s3')
 
         bucket_name, path = dict2bucket(self.params)
-        # path = get_dt_unique_name(path+'_part', only_seconds=True)
+        path = part_key(path, self._part)
 
         obj = s3.Object(bucket_name, path)
 
@@ -114,6 +122,8 @@ class S3Backend(Base):
         except botocore.exceptions.ClientError as e:
             raise prf_exc.HTTPBadRequest('Error:%r, Bucket:%s, Path:%s' % (e, bucket_name, path))
 
+        self._part += 1
+
         success = total = len(objs)
         log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s',
                                             total, success, 0, 0)
@@ -0,0 +1,79 @@
+'''
+    Catalog of the target datasets (namespaces, collection names, indexes, stats), cached for `ttl`
+    seconds so listing a cluster with thousands of collections does not go to the server on every call.
+'''
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class Catalog(object):
+    '''
+        Values by key tuple, fetched on a miss and kept `ttl` seconds.
+        `get_many` fetches the missing keys concurrently, on up to `max_workers` threads.
+    '''
+
+    def __init__(self, ttl=60, max_workers=16):
+        self.ttl = ttl
+        self.max_workers = max_workers
+
+        self._lock = Lock()
+        self._entries = {}
+
+    def cached(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return True, entry[1]
+
+        return False, None
+
+    def store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def get(self, key, fetch):
+        found, value = self.cached(key)
+        if found:
+            return value
+
+        return self.store(key, fetch())
+
+    def get_many(self, keys, fetch):
+        '''
+            `{key: value}` for all `keys`, `fetch(key)` is called for the missing ones.
+        '''
+        values = {}
+        missing = []
+
+        for key in keys:
+            found, value = self.cached(key)
+            if found:
+                values[key] = value
+            else:
+                missing.append(key)
+
+        if len(missing) == 1:
+            values[missing[0]] = self.store(missing[0], fetch(missing[0]))
+
+        elif missing:
+            log.debug('Catalog fetching %s keys', len(missing))
+            with ThreadPoolExecutor(min(self.max_workers, len(missing))) as executor:
+                for key, value in zip(missing, executor.map(fetch, missing)):
+                    values[key] = self.store(key, value)
+
+        return values
+
+    def refresh(self, *prefix):
+        '''
+            Drop the entries whose key starts with `prefix`, all of them if no prefix.
+        '''
+        with self._lock:
+            for key in list(self._entries):
+                if key[:len(prefix)] == prefix:
+                    del self._entries[key]
@@ -0,0 +1,108 @@
+'''
+    Checkpoint stores for resumable jobs. A checkpoint is the number of source records
+    whose writes are committed, plus the flush counts at that point, keyed by job id.
+'''
+import json
+import logging
+import os
+from datetime import datetime
+
+from slovar import slovar
+
+import datasets
+
+log = logging.getLogger(__name__)
+
+
+class FileCheckpoints(object):
+    '''
+        One JSON file per job in `path`.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def job_path(self, job_id):
+        return os.path.join(self.path, '%s.json' % job_id)
+
+    def load(self, job_id):
+        try:
+            with open(self.job_path(job_id)) as ckp_file:
+                return slovar(json.load(ckp_file))
+        except FileNotFoundError:
+            return None
+
+    def save(self, job_id, state):
+        path = self.job_path(job_id)
+        tmp_path = '%s.tmp' % path
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(tmp_path, 'w') as ckp_file:
+            json.dump(state, ckp_file, default=str)
+
+        # a crash mid-write leaves the previous checkpoint in place
+        os.replace(tmp_path, path)
+
+    def __str__(self):
+        return 'file:%s' % self.path
+
+
+class MongoCheckpoints(object):
+    '''
+        One document per job, `_id` is the job id.
+    '''
+    def __init__(self, ns, name):
+        self.ns = ns
+        self.name = name
+
+    def collection(self):
+        import mongoengine as mongo
+        from datasets.backends.mongo import connect_namespace
+
+        connect_namespace(datasets.Settings, self.ns)
+        return mongo.connection.get_db(self.ns)[self.name]
+
+    def load(self, job_id):
+        doc = self.collection().find_one({'_id': job_id})
+        if not doc:
+            return None
+
+        doc.pop('_id')
+        return slovar(doc)
+
+    def save(self, job_id, state):
+        self.collection().replace_one({'_id': job_id}, dict(state), upsert=True)
+
+    def __str__(self):
+        return 'mongo:%s.%s' % (self.ns, self.name)
+
+
+def build_checkpoints(spec):
+    '''
+        `spec` is `file:<dir>` or `mongo:<ns>.<name>`.
+    '''
+    target, _, ds = spec.partition(':')
+
+    if not ds:
+        raise ValueError('checkpoint must be `file:<dir>` or `mongo:<ns>.<name>`, got `%s`' % spec)
+
+    if target == 'file':
+        return FileCheckpoints(ds)
+
+    if target == 'mongo':
+        ns, _, name = ds.rpartition('.')
+        if not ns:
+            raise ValueError('mongo checkpoint needs `<ns>.<name>`, got `%s`' % ds)
+        return MongoCheckpoints(ns, name)
+
+    raise ValueError('unknown checkpoint store `%s`' % target)
+
+
+def checkpoint_state(position, counts, done=False):
+    return slovar(
+        position=position,
+        total=counts.total,
+        success=counts.success,
+        errors=counts.errors,
+        done=done,
+        updated_at=datetime.utcnow(),
+    )
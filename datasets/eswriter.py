@@ -0,0 +1,191 @@
+'''
+    Bulk writes to ES: actions are serialized to NDJSON (with orjson when installed), optionally gzipped,
+    and sent on several worker threads, so serialization and network overlap.
+'''
+import gzip
+import json
+import logging
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from urllib.parse import urlencode
+
+from elasticsearch import TransportError, ConnectionError
+from elasticsearch.exceptions import HTTP_EXCEPTIONS
+from elasticsearch.helpers import expand_action
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+# fast levels, bulk bodies compress well already and the CPU is better spent serializing
+GZIP_LEVEL = 1
+
+
+def json_default(obj):
+    # same conversions as the elasticsearch client serializer
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+
+    raise TypeError('Unable to serialize %r (type: %s)' % (obj, type(obj)))
+
+
+def dumps(obj):
+    '''
+        `obj` as JSON bytes.
+    '''
+    if orjson:
+        try:
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. ints over 64 bits, json takes those
+            pass
+
+    return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class BulkWriter(object):
+    '''
+        Sends bulk actions (as taken by `elasticsearch.helpers.bulk`) in requests of `bulk_size` actions,
+        on `workers` threads. Actions are spread across the workers by `_id`, so the actions on a doc are
+        sent in order. With `compress`, request bodies are gzipped.
+    '''
+
+    def __init__(self, client, workers=1, bulk_size=500, compress=False, refresh=True):
+        self.client = client
+        self.workers = max(1, workers)
+        self.bulk_size = max(1, bulk_size)
+        self.compress = compress
+        self.params = {'refresh': 'true'} if refresh else {}
+
+        self._executor = None
+
+    def bulk(self, actions):
+        '''
+            `(success, errors)` like `elasticsearch.helpers.bulk` with `raise_on_error=False`
+            and `raise_on_exception=False`.
+        '''
+        if self.workers == 1 or len(actions) <= self.bulk_size:
+            return self.write(actions)
+
+        shards = [[] for _ in range(self.workers)]
+        for ix, action in enumerate(actions):
+            _id = action.get('_id')
+            shard = zlib.crc32(str(_id).encode('utf-8')) if _id is not None else ix
+            shards[shard % self.workers].append(action)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='es-bulk')
+
+        success = 0
+        errors = []
+        for shard_success, shard_errors in self._executor.map(self.write, [it for it in shards if it]):
+            success += shard_success
+            errors += shard_errors
+
+        return success, errors
+
+    def write(self, actions):
+        success = 0
+        errors = []
+
+        for start in range(0, len(actions), self.bulk_size):
+            req_success, req_errors = self.write_request(actions[start:start+self.bulk_size])
+            success += req_success
+            errors += req_errors
+
+        return success, errors
+
+    def write_request(self, actions):
+        expanded = [expand_action(it) for it in actions]
+
+        lines = []
+        for meta, source in expanded:
+            lines.append(dumps(meta))
+            if source is not None:
+                lines.append(dumps(source))
+        lines.append(b'')
+
+        try:
+            response = self.send(b'\n'.join(lines))
+        except TransportError as e:
+            return 0, [self.request_error(meta, source, e) for meta, source in expanded]
+
+        success = 0
+        errors = []
+        for item in response['items']:
+            op_type, info = next(iter(item.items()))
+            if 200 <= info.get('status', 500) < 300:
+                success += 1
+            else:
+                errors.append({op_type: info})
+
+        return success, errors
+
+    def request_error(self, meta, source, e):
+        op_type, action = next(iter(meta.items()))
+
+        info = {'error': str(e), 'status': e.status_code, 'exception': e}
+        info.update(action)
+        if op_type != 'delete':
+            info['data'] = source
+
+        return {op_type: info}
+
+    def send(self, body):
+        '''
+            POST `body` to `_bulk` through the client transport, which retries, fails over and sniffs.
+            Compressed requests go to one connection of the transport, and through the transport as is
+            if that connection fails.
+        '''
+        transport = self.client.transport
+
+        if self.compress:
+            connection = transport.get_connection()
+
+            if getattr(connection, 'pool', None) is None:
+                log.warning('%s can not send compressed requests, sending as is', connection.__class__.__name__)
+                self.compress = False
+            else:
+                try:
+                    return self.send_compressed(connection, body)
+                except ConnectionError as e:
+                    log.warning('Compressed bulk request to %s failed, sending it as is: %r', connection, e)
+                    transport.mark_dead(connection)
+
+        return transport.perform_request('POST', '/_bulk', params=self.params, body=body)
+
+    def send_compressed(self, connection, body):
+        url = '%s/_bulk' % connection.url_prefix
+        if self.params:
+            url = '%s?%s' % (url, urlencode(self.params))
+
+        headers = dict(connection.headers)
+        headers['content-type'] = 'application/x-ndjson'
+        headers['content-encoding'] = 'gzip'
+
+        try:
+            response = connection.pool.urlopen('POST', url, gzip.compress(body, GZIP_LEVEL), retries=False,
+                                               headers=headers)
+            raw_data = response.data.decode('utf-8')
+        except Exception as e:
+            raise ConnectionError('N/A', str(e), e)
+
+        if not 200 <= response.status < 300:
+            raise HTTP_EXCEPTIONS.get(response.status, TransportError)(response.status, raw_data)
+
+        return json.loads(raw_data)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
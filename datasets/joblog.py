@@ -0,0 +1,235 @@
+'''
+    Job log sinks. Job logs are handed over when the data they describe is flushed
+    and written in batches by a background thread, off the data write path.
+'''
+import json
+import logging
+import queue
+import time
+from threading import Lock, Thread
+
+from slovar import slovar
+from prf.utils import chunks
+
+import datasets
+from datasets.retry import backoff
+
+log = logging.getLogger(__name__)
+
+_CLOSE = object()
+
+
+class LogSink(object):
+    '''
+        Batches job logs and writes them from a background thread.
+        Subclasses implement `write(batch)`, returning `(success, errors)`.
+    '''
+    flush_interval = 1.0
+    max_errors = 100
+
+    def __init__(self, batch_size=1000, queue_size=100):
+        self.batch_size = batch_size
+        self.stats = slovar(total=0, written=0, errors=0)
+        self.errors = []
+
+        self._lock = Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def add(self, logs):
+        if not logs:
+            return
+
+        with self._lock:
+            if not self._thread:
+                self._thread = Thread(target=self.run, daemon=True, name='joblog-%s' % self)
+                self._thread.start()
+
+        # blocks when the writer is behind
+        self._queue.put(logs)
+
+    def close(self):
+        '''
+            Write what is queued and stop the writer. Returns the errors of the whole job.
+        '''
+        with self._lock:
+            if self._thread:
+                self._queue.put(_CLOSE)
+                self._thread.join()
+                self._thread = None
+
+        return self.errors
+
+    def run(self):
+        batch = []
+        while True:
+            try:
+                logs = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                logs = None
+
+            if logs is _CLOSE:
+                break
+
+            if logs:
+                batch.extend(logs)
+
+            if batch and (logs is None or len(batch) >= self.batch_size):
+                self.write_batch(batch)
+                batch = []
+
+        self.write_batch(batch)
+
+    def write_batch(self, batch):
+        for chunk in chunks(batch, self.batch_size):
+            try:
+                success, errors = self.write(chunk)
+            except Exception as e:
+                log.error('%s failed to write %s job logs: %r', self, len(chunk), e)
+                success, errors = 0, [{'error': repr(e)}]*len(chunk)
+
+            self.stats.total += len(chunk)
+            self.stats.written += success
+            self.stats.errors += len(errors)
+            self.errors.extend(errors[:self.max_errors-len(self.errors)])
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class ESLogSink(LogSink):
+    retries = 2
+    retry_backoff = 0.5
+    retry_max_backoff = 30.0
+
+    def __init__(self, index, **kw):
+        super().__init__(**kw)
+        self.index = index
+
+    def write(self, batch):
+        from prf.es import ES
+
+        actions = []
+        for each in batch:
+            action = slovar({
+                '_index': self.index,
+                '_op_type': 'create',
+                '_source': each.unflat()
+            })
+
+            if ES.version.major < 7:
+                action['_type'] = 'notanalyzed'
+
+            actions.append(action)
+
+        attempt = 0
+        success, errors, retries = ES.flush(actions)
+        while retries and attempt < self.retries:
+            attempt += 1
+            # give a throttled cluster time to catch up
+            time.sleep(backoff(attempt, self.retry_backoff, self.retry_max_backoff))
+
+            success2, errors2, retries = ES.flush(retries)
+            success += success2
+            errors += errors2
+
+        return success, errors + list(retries)
+
+    def __str__(self):
+        return 'es:%s' % self.index
+
+
+class MongoLogSink(LogSink):
+    def __init__(self, ns, name, **kw):
+        super().__init__(**kw)
+        self.ns = ns
+        self.name = name
+
+    def write(self, batch):
+        import mongoengine as mongo
+        from pymongo.errors import BulkWriteError
+        from datasets.backends.mongo import connect_namespace
+
+        connect_namespace(datasets.Settings, self.ns)
+        collection = mongo.connection.get_db(self.ns)[self.name]
+
+        docs = []
+        for each in batch:
+            doc = dict(each.unflat())
+            if 'id' in doc:
+                doc['_id'] = doc.pop('id')
+            docs.append(doc)
+
+        try:
+            return len(collection.insert_many(docs, ordered=False).inserted_ids), []
+        except BulkWriteError as e:
+            return e.details['nInserted'], e.details['writeErrors']
+
+    def __str__(self):
+        return 'mongo:%s.%s' % (self.ns, self.name)
+
+
+class FileLogSink(LogSink):
+    '''
+        Appends one JSON document per line to `path`.
+    '''
+    def __init__(self, path, **kw):
+        super().__init__(**kw)
+        self.path = path
+
+    def write(self, batch):
+        with open(self.path, 'a') as log_file:
+            for each in batch:
+                log_file.write(json.dumps(each.unflat(), default=str))
+                log_file.write('\n')
+
+        return len(batch), []
+
+    def __str__(self):
+        return 'file:%s' % self.path
+
+
+class SummaryLogSink(LogSink):
+    '''
+        Writes nothing, only sums up the per chunk logs. The totals go into the job result.
+    '''
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.stats = slovar(chunks=0, total=0, success=0, errors=0)
+
+    def add(self, logs):
+        with self._lock:
+            for each in logs:
+                self.stats.chunks += 1
+                self.stats.total += each.target_chunk.total
+                self.stats.success += each.target_chunk.success
+                self.stats.errors += each.target_chunk.errors
+
+
+def build_log_sink(target, ds=None, **kw):
+    '''
+        `target` is one of `es`, `mongo`, `file` or `summary`.
+        `ds` is the ES index, the `<ns>.<name>` of the Mongo collection or the file path.
+    '''
+    if target == 'summary':
+        return SummaryLogSink(**kw)
+
+    if not ds:
+        return None
+
+    if target == 'es':
+        return ESLogSink(ds, **kw)
+
+    if target == 'mongo':
+        ns, _, name = ds.rpartition('.')
+        if not ns:
+            raise ValueError('mongo job log needs `<ns>.<name>`, got `%s`' % ds)
+        return MongoLogSink(ns, name, **kw)
+
+    if target == 'file':
+        return FileLogSink(ds, **kw)
+
+    raise ValueError('unknown job log sink `%s`' % target)
@@ -0,0 +1,217 @@
+import logging
+import time
+from threading import Lock
+from collections import defaultdict
+
+from slovar import slovar
+
+log = logging.getLogger(__name__)
+
+# latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float('inf'))
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullMetrics(object):
+    '''
+        Used when metrics are off. Same interface as `Metrics`, does nothing.
+    '''
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, event, value=1):
+        pass
+
+    def add_bytes(self, stage, nb_bytes):
+        pass
+
+    def summary(self):
+        return slovar()
+
+    def drain(self):
+        return None
+
+    def merge(self, state):
+        pass
+
+    def export(self):
+        pass
+
+
+class Metrics(object):
+    '''
+        Per job counters, latency histograms and written bytes, keyed by pipeline stage.
+        Safe to update from the flush worker threads.
+    '''
+    enabled = True
+
+    def __init__(self, labels=None, exporters=None):
+        self.labels = slovar(labels or {})
+        self.exporters = exporters or []
+
+        self._lock = Lock()
+        self.latency = {}
+        self.events = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self.latency.get(stage)
+            if not hist:
+                hist = self.latency[stage] = slovar(buckets=[0]*len(BUCKETS), sum=0.0, count=0, max=0.0)
+
+            for ix, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist.buckets[ix] += 1
+                    break
+
+            hist.sum += seconds
+            hist.count += 1
+            hist.max = max(hist.max, seconds)
+
+    def incr(self, event, value=1):
+        with self._lock:
+            self.events[event] += value
+
+    def add_bytes(self, stage, nb_bytes):
+        with self._lock:
+            self.bytes[stage] += nb_bytes
+
+    def drain(self):
+        '''
+            Take the numbers recorded so far and start over. Used to send a worker process' numbers to `merge`.
+        '''
+        with self._lock:
+            state = (self.latency, dict(self.events), dict(self.bytes))
+            self.latency = {}
+            self.events = defaultdict(int)
+            self.bytes = defaultdict(int)
+
+        return state
+
+    def merge(self, state):
+        if not state:
+            return
+
+        latency, events, nb_bytes = state
+
+        with self._lock:
+            for stage, other in latency.items():
+                hist = self.latency.get(stage)
+                if not hist:
+                    self.latency[stage] = other
+                    continue
+
+                hist.buckets = [aa + bb for aa, bb in zip(hist.buckets, other.buckets)]
+                hist.sum += other.sum
+                hist.count += other.count
+                hist.max = max(hist.max, other.max)
+
+            for event, value in events.items():
+                self.events[event] += value
+
+            for stage, value in nb_bytes.items():
+                self.bytes[stage] += value
+
+    def summary(self):
+        '''
+            Short per stage numbers, meant to go into the job result.
+        '''
+        with self._lock:
+            stages = slovar()
+            for stage, hist in sorted(self.latency.items()):
+                stages[stage] = slovar(
+                    count=hist.count,
+                    total_s=round(hist.sum, 6),
+                    avg_ms=round(hist.sum/hist.count*1000, 3),
+                    max_ms=round(hist.max*1000, 3),
+                )
+
+            return slovar(
+                stages=stages,
+                events=dict(self.events),
+                bytes=dict(self.bytes),
+            )
+
+    def to_prometheus(self, prefix='datasets'):
+        '''
+            Prometheus text exposition format.
+        '''
+        def labels(**extra):
+            _labels = self.labels.copy().update(extra)
+            return ','.join('%s="%s"' % (kk, str(vv).replace('"', '\\"'))
+                                for kk, vv in sorted(_labels.items()))
+
+        lines = []
+
+        with self._lock:
+            lines.append('# TYPE %s_stage_seconds histogram' % prefix)
+            for stage, hist in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_stage_seconds_bucket{%s} %s' % (
+                                    prefix, labels(stage=stage, le=le), cumulative))
+
+                lines.append('%s_stage_seconds_sum{%s} %s' % (prefix, labels(stage=stage), hist.sum))
+                lines.append('%s_stage_seconds_count{%s} %s' % (prefix, labels(stage=stage), hist.count))
+
+            lines.append('# TYPE %s_events_total counter' % prefix)
+            for event, value in sorted(self.events.items()):
+                lines.append('%s_events_total{%s} %s' % (prefix, labels(event=event), value))
+
+            lines.append('# TYPE %s_bytes_written_total counter' % prefix)
+            for stage, value in sorted(self.bytes.items()):
+                lines.append('%s_bytes_written_total{%s} %s' % (prefix, labels(stage=stage), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        for exporter in self.exporters:
+            try:
+                exporter(self)
+            except Exception as e:
+                log.error('Metrics exporter %s failed: %r', exporter, e)
+
+
+def prometheus_file_exporter(path):
+    '''
+        Writes the metrics to `path`, e.g. for the node_exporter textfile collector.
+    '''
+    def export(metrics):
+        with open(path, 'w') as prom_file:
+            prom_file.write(metrics.to_prometheus())
+
+    return export
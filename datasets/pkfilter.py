@@ -0,0 +1,118 @@
+'''
+    Pre-filters for `skip_by` insert jobs: the keys already in the target, so records
+    that would only fail as duplicates are dropped before they are buffered.
+'''
+import dbm
+import hashlib
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+
+class PKSet(object):
+    '''
+        Exact, in memory.
+    '''
+    def __init__(self):
+        self.keys = set()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        self.keys.add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        pass
+
+
+class BloomFilter(object):
+    '''
+        Compact, in memory. A new key is taken for an existing one (and skipped) with
+        `error_rate` probability, as long as no more than `capacity` keys are added.
+    '''
+    def __init__(self, capacity, error_rate=1e-6):
+        capacity = max(capacity, 1000)
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nb_bits = int(-capacity*math.log(error_rate) / math.log(2)**2)
+        self.nb_hashes = max(1, round(self.nb_bits/capacity * math.log(2)))
+        self.bits = bytearray((self.nb_bits+7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return ((h1 + ix*h2) % self.nb_bits for ix in range(self.nb_hashes))
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+        self.count += 1
+        if self.count == self.capacity+1:
+            log.warning('Bloom filter is over its capacity of %s keys, expect more false positives',
+                            self.capacity)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        pass
+
+
+class DiskPKSet(object):
+    '''
+        Exact, in a dbm file at `path`, for targets whose keys do not fit in memory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.db = dbm.open(path, 'n')
+        self.count = 0
+
+    def __contains__(self, key):
+        return key.encode('utf-8') in self.db
+
+    def add(self, key):
+        self.db[key.encode('utf-8')] = b''
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.db.close()
+
+
+def build_pk_filter(spec, capacity=0):
+    '''
+        `spec` is `set`, `bloom[:<error_rate>]` or `disk:<path>`.
+        `capacity` is the expected number of keys, used to size the Bloom filter.
+    '''
+    kind, _, arg = spec.partition(':')
+
+    if kind == 'set':
+        return PKSet()
+
+    if kind == 'bloom':
+        # room for the new keys of this job too
+        return BloomFilter(int(capacity*1.2), float(arg) if arg else 1e-6)
+
+    if kind == 'disk':
+        if not arg:
+            raise ValueError('disk skip filter needs a path: `disk:<path>`')
+        return DiskPKSet(arg)
+
+    raise ValueError('unknown skip filter `%s`' % spec)
@@ -0,0 +1,238 @@
+'''
+    Parallel reads of a Mongo collection: the `_id` space is split in ranges, read on concurrent cursors,
+    and documents come back as plain dicts in chunks, for exports and copies to other backends.
+'''
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from slovar import slovar
+
+log = logging.getLogger(__name__)
+
+SPLITS = ['auto', 'vector', 'sample', 'minmax']
+
+# ends the stream of a range reader
+_DONE = object()
+
+
+class MongoReader(object):
+    '''
+        Reads `collection` in `partitions` `_id` ranges on `workers` threads.
+        `query` and `fields` filter and project every range, `batch_size` is the cursor batch size
+        and the size of the chunks yielded. Chunks come in the order they are read, not in `_id` order.
+
+        `split` picks how the range bounds are found:
+            vector: the `splitVector` command, needs privileges not every user has
+            sample: `$sample`d `_id`s
+            minmax: even split between the min and max `_id`, for ObjectId and numeric ids
+            auto: the first of these that works
+    '''
+
+    def __init__(self, collection, query=None, fields=None, batch_size=1000, workers=4,
+                 partitions=None, split='auto', queue_size=None):
+        if split not in SPLITS:
+            raise ValueError('`split` must be one of %s, got `%s`' % (SPLITS, split))
+
+        self.collection = collection
+        self.query = query or {}
+        self.projection = dict.fromkeys(fields, 1) if fields else None
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.partitions = max(1, partitions or self.workers*4)
+        self.split = split
+        self.queue_size = queue_size or self.workers*2
+
+    def split_points(self):
+        if self.partitions == 1:
+            return []
+
+        splitters = {
+            'vector': self.split_vector,
+            'sample': self.split_sample,
+            'minmax': self.split_minmax,
+        }
+
+        for name in (['vector', 'sample', 'minmax'] if self.split == 'auto' else [self.split]):
+            try:
+                points = splitters[name]()
+            except (OperationFailure, NotImplementedError, ValueError, TypeError) as e:
+                if self.split != 'auto':
+                    raise
+                log.debug('`%s` split of `%s` failed: %r', name, self.collection.name, e)
+                continue
+
+            if points is not None:
+                points = same_type(points)
+                log.debug('`%s` split of `%s` in %s ranges', name, self.collection.name, len(points)+1)
+                return points
+
+        return []
+
+    def split_vector(self):
+        stats = self.collection.database.command({'collstats': self.collection.name})
+        if not stats.get('size'):
+            return []
+
+        max_bytes = max(1, stats['size'] // self.partitions)
+        result = self.collection.database.command({
+            'splitVector': self.collection.full_name,
+            'keyPattern': {'_id': 1},
+            'maxChunkSizeBytes': max_bytes,
+        })
+
+        return [it['_id'] for it in result['splitKeys']]
+
+    def split_sample(self):
+        nb_samples = self.partitions * 10
+        ids = sorted(same_type([it['_id'] for it in self.collection.aggregate(
+                [{'$sample': {'size': nb_samples}}, {'$project': {'_id': 1}}])]))
+
+        if len(ids) < self.partitions:
+            return sorted(set(ids))
+
+        step = len(ids) / self.partitions
+        return sorted(set(ids[int(step*ix)] for ix in range(1, self.partitions)))
+
+    def split_minmax(self):
+        first = self.collection.find_one({}, {'_id': 1}, sort=[('_id', 1)])
+        last = self.collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        if not first:
+            return []
+
+        lo, hi = first['_id'], last['_id']
+
+        if isinstance(lo, ObjectId) and isinstance(hi, ObjectId):
+            lo_int = int.from_bytes(lo.binary, 'big')
+            hi_int = int.from_bytes(hi.binary, 'big')
+            return sorted(set(ObjectId((lo_int + (hi_int-lo_int)*ix//self.partitions).to_bytes(12, 'big'))
+                                for ix in range(1, self.partitions)))
+
+        if isinstance(lo, (int, float)) and isinstance(hi, (int, float)) \
+                and not isinstance(lo, bool) and not isinstance(hi, bool):
+            step = (hi - lo) / self.partitions
+            return sorted(set(lo + step*ix for ix in range(1, self.partitions)))
+
+        raise ValueError('can not split `_id`s of type %s' % type(lo).__name__)
+
+    def ranges(self):
+        bounds = [None] + self.split_points() + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def range_query(self, lo, hi):
+        '''
+            `$gte`/`$lt` only match `_id`s of the bound type, so the first range takes every other type.
+        '''
+        id_range = {}
+        if lo is None:
+            if hi is not None:
+                id_range['$not'] = {'$gte': hi}
+        else:
+            id_range['$gte'] = lo
+            if hi is not None:
+                id_range['$lt'] = hi
+
+        if not id_range:
+            return self.query
+        if not self.query:
+            return {'_id': id_range}
+
+        return {'$and': [self.query, {'_id': id_range}]}
+
+    def read_range(self, lo, hi, out, stop):
+        chunk = []
+        cursor = self.collection.find(self.range_query(lo, hi), self.projection, batch_size=self.batch_size)
+
+        try:
+            for doc in cursor:
+                chunk.append(doc)
+                if len(chunk) >= self.batch_size:
+                    if not put(out, chunk, stop):
+                        return
+                    chunk = []
+
+            if chunk:
+                put(out, chunk, stop)
+        finally:
+            cursor.close()
+
+    def __iter__(self):
+        '''
+            Chunks of documents, as dicts.
+        '''
+        ranges = self.ranges()
+        out = queue.Queue(maxsize=self.queue_size)
+        stop = Event()
+
+        def run(bounds):
+            if stop.is_set():
+                return
+
+            try:
+                self.read_range(bounds[0], bounds[1], out, stop)
+            except Exception as e:
+                put(out, e, stop)
+            finally:
+                put(out, _DONE, stop)
+
+        executor = ThreadPoolExecutor(min(self.workers, len(ranges)), thread_name_prefix='mongo-reader')
+        try:
+            for bounds in ranges:
+                executor.submit(run, bounds)
+
+            pending = len(ranges)
+            while pending:
+                item = out.get()
+                if item is _DONE:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # let the readers blocked on a full queue go, the ones not started yet return right away
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def records(self):
+        '''
+            Documents one by one, as slovars with `_id` renamed `id`, ready for `Backend.process_many`.
+        '''
+        for chunk in self:
+            for doc in chunk:
+                doc = slovar(doc)
+                if '_id' in doc:
+                    doc['id'] = doc.pop('_id')
+                yield doc
+
+
+def type_class(value):
+    # MongoDB compares numbers of any type with each other
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 'number'
+    return type(value)
+
+
+def same_type(values):
+    '''
+        The `values` of the most common type, range bounds of different types would leave gaps.
+    '''
+    by_type = {}
+    for value in values:
+        by_type.setdefault(type_class(value), []).append(value)
+
+    return max(by_type.values(), key=len) if by_type else []
+
+
+def put(out, item, stop):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
@@ -0,0 +1,63 @@
+'''
+    Requeue of the items a bulk flush got back as retryable (throttled, node unavailable, network),
+    so they are merged into later chunks after a backoff instead of being retried right away.
+'''
+import heapq
+import random
+import time
+from itertools import count
+from threading import Lock
+
+
+def backoff(attempt, base=0.5, max_delay=30.0):
+    '''
+        Seconds to wait before retry `attempt` (from 1): doubles from `base` up to `max_delay`,
+        the second half jittered.
+    '''
+    delay = min(max_delay, base * 2**(attempt-1))
+    return delay/2 + random.uniform(0, delay/2)
+
+
+class RetryQueue(object):
+    '''
+        Items with the time they are due. The backoff doubles with every attempt,
+        from `base` up to `max_delay` seconds, with jitter so retries do not come back in bursts.
+    '''
+
+    def __init__(self, base=0.5, max_delay=30.0):
+        self.base = base
+        self.max_delay = max_delay
+
+        self._lock = Lock()
+        self._heap = []
+        self._seq = count()
+
+    def backoff(self, attempt):
+        return backoff(attempt, self.base, self.max_delay)
+
+    def push(self, item, attempt):
+        due = time.monotonic() + self.backoff(attempt)
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._seq), item, attempt))
+
+    def pop_due(self):
+        '''
+            The `(item, attempt)` pairs that are due, oldest first.
+        '''
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, item, attempt = heapq.heappop(self._heap)
+                due.append((item, attempt))
+
+        return due
+
+    def next_delay(self):
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][0] - time.monotonic())
+
+    def __len__(self):
+        return len(self._heap)
@@ -0,0 +1,71 @@
+'''
+    Flush chunk sizing: byte-aware chunking and an adaptive controller for the number of items per bulk request.
+'''
+import logging
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+def byte_chunks(items, sizes, max_count, max_bytes=0):
+    '''
+        Split `items` in chunks of at most `max_count` items and `max_bytes` bytes.
+        `sizes` are the item sizes, `max_count` is a number or a callable read for every new chunk.
+        Yields `(chunk, nb_bytes)`. An item bigger than `max_bytes` goes alone.
+    '''
+    count_of = max_count if callable(max_count) else lambda: max_count
+
+    chunk = []
+    nb_bytes = 0
+    limit = count_of()
+
+    for item, size in zip(items, sizes):
+        if chunk and (len(chunk) >= limit or (max_bytes and nb_bytes+size > max_bytes)):
+            yield chunk, nb_bytes
+            chunk = []
+            nb_bytes = 0
+            limit = count_of()
+
+        chunk.append(item)
+        nb_bytes += size
+
+    if chunk:
+        yield chunk, nb_bytes
+
+
+class ChunkSizer(object):
+    '''
+        Number of items per flush, moved toward `target_latency` seconds and `target_bytes` bytes
+        per request from the observed flushes. Halved when the target pushes back (e.g. ES 429).
+        Safe to update from the flush worker threads.
+    '''
+
+    def __init__(self, size, min_size, max_size, target_latency=1.0, target_bytes=0):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = min(self.max_size, max(self.min_size, size))
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+
+        self._lock = Lock()
+
+    def __call__(self):
+        return self.size
+
+    def observe(self, nb_items, nb_bytes, seconds, throttled=False):
+        if not nb_items:
+            return
+
+        with self._lock:
+            if throttled:
+                self.size = max(self.min_size, self.size // 2)
+                log.debug('Target is throttling, flush size down to %s', self.size)
+                return
+
+            wanted = nb_items * self.target_latency / max(seconds, 1e-6)
+            if self.target_bytes and nb_bytes:
+                wanted = min(wanted, nb_items * self.target_bytes / nb_bytes)
+
+            # move half way there, and at most double per flush
+            size = min(self.size + (wanted - self.size) / 2, self.size * 2)
+            self.size = int(min(self.max_size, max(self.min_size, size)))
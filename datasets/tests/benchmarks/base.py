@@ -0,0 +1,176 @@
+import gzip
+import json
+import os
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from slovar import slovar
+
+from datasets.backends import Backend
+
+ROUNDS = int(os.environ.get('BENCH_ROUNDS', 3))
+NB_RECORDS = int(os.environ.get('BENCH_RECORDS', 1000))
+
+# (record width, nesting depth)
+SHAPES = {
+    'narrow': (10, 0),
+    'wide': (100, 0),
+    'nested': (10, 2),
+}
+BUFFER_SIZES = [100, 1000]
+
+
+def make_records(count, width, depth):
+    def value(ix, level):
+        if level:
+            return {'n%s' % jx: value(ix, level-1) for jx in range(3)}
+        return 'value-%s' % ix
+
+    for ix in range(count):
+        data = slovar(('f%s' % jx, value(ix, depth)) for jx in range(width))
+        data['uid'] = 'uid-%s' % ix
+        yield data
+
+
+def peak_memory_mb(func):
+    '''
+        Peak Python heap while `func` runs. Tracing slows the run down, so it is kept out of the timed rounds.
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024.0 / 1024.0
+
+
+def run_job(benchmark, params, shape, setup=None):
+    '''
+        Times `Backend(params).process(data)` over NB_RECORDS records of `shape`.
+        `setup`, if passed, is called untimed with the same records before every round,
+        e.g. to reset the target or seed documents to update.
+        Peak memory is measured on one more, untimed, round.
+    '''
+    width, depth = SHAPES[shape]
+
+    def _setup():
+        if setup:
+            setup(make_records(NB_RECORDS, width, depth))
+        return (), {}
+
+    def job():
+        return Backend(slovar(params), slovar()).process(make_records(NB_RECORDS, width, depth))
+
+    _setup()
+    benchmark.extra_info['peak_memory_mb'] = round(peak_memory_mb(job), 1)
+
+    result = benchmark.pedantic(job, setup=_setup, rounds=ROUNDS)
+
+    benchmark.extra_info['docs_per_sec'] = round(NB_RECORDS / benchmark.stats.stats.mean)
+    return result
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(handler):
+    server = StandInServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    '''
+        Just enough of the ES API for ESBackend: version, mapping, aliases, cluster settings and _bulk.
+    '''
+    version = '6.8.0'
+
+    def log_message(self, *arg):
+        pass
+
+    def respond(self, body, status=200):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def index_name(self):
+        return self.path.split('?')[0].strip('/').split('/')[0]
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+
+        if path == '/':
+            return self.respond({'version': {'number': self.version}})
+
+        index = self.index_name()
+
+        if '/_mapping' in path:
+            return self.respond({index: {'mappings': {'notanalyzed': {'properties': {}}}}})
+
+        if '/_alias' in path:
+            return self.respond({index: {'aliases': {}}})
+
+        self.respond({}, status=404)
+
+    def do_PUT(self):
+        self.read_body()
+        self.respond({'acknowledged': True})
+
+    def do_POST(self):
+        body = self.read_body()
+
+        if '_bulk' not in self.path:
+            return self.respond({'acknowledged': True})
+
+        items = []
+        lines = iter(body.decode().splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+
+            action = json.loads(line)
+            (op, meta), = action.items()
+            if op != 'delete':
+                next(lines)
+
+            items.append({op: dict(_index=meta.get('_index'), _id=meta.get('_id'),
+                                   status=201 if op in ['create', 'index'] else 200)})
+
+        self.respond({'took': 1, 'errors': False, 'items': items})
+
+    def do_DELETE(self):
+        self.respond({'acknowledged': True})
+
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    payload = b'[]'
+
+    def log_message(self, *arg):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
@@ -0,0 +1,74 @@
+'''
+    Local stand-ins for every backend, so the benchmarks run without a cluster.
+
+    Run with:
+        py.test datasets/tests/benchmarks --benchmark-autosave
+    and gate an upgrade against the saved run with:
+        py.test datasets/tests/benchmarks --benchmark-compare --benchmark-compare-fail=mean:20%
+
+    Set BENCH_MONGO_HOST to benchmark against a real mongod instead of mongomock.
+'''
+import os
+
+import mock
+import pytest
+from slovar import slovar
+
+import datasets
+from datasets.tests.benchmarks.base import serve, FakeESHandler, FakeHTTPHandler
+
+
+@pytest.fixture
+def mongo_backend():
+    from prf.mongodb import mongo_disconnect
+
+    host = os.environ.get('BENCH_MONGO_HOST')
+    datasets.Settings = slovar({'mongodb.host': host or 'localhost', 'mongodb.db': 'bench'})
+
+    if host:
+        yield
+    else:
+        mongomock = pytest.importorskip('mongomock')
+        with mock.patch('mongoengine.connection.MongoClient', mongomock.MongoClient):
+            yield
+
+    mongo_disconnect('bench')
+
+
+@pytest.fixture(scope='session')
+def es_backend():
+    from prf.es import ES
+
+    server = serve(FakeESHandler)
+    ES.setup(slovar({'es.urls': 'http://127.0.0.1:%s' % server.server_port}))
+    yield
+    server.shutdown()
+
+
+@pytest.fixture
+def csv_backend(tmpdir):
+    from prf.csv import CSV
+
+    CSV.setup(slovar())
+    datasets.Settings = slovar({'csv.root': str(tmpdir)})
+    yield str(tmpdir)
+
+
+@pytest.fixture
+def s3_backend():
+    moto = pytest.importorskip('moto')
+    import boto3
+
+    mock_aws = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        boto3.resource('s3').create_bucket(Bucket='bench')
+        yield
+
+
+@pytest.fixture
+def http_backend():
+    server = serve(FakeHTTPHandler)
+    yield 'http://127.0.0.1:%s/' % server.server_port
+    server.shutdown()
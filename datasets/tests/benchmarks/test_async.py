@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from datasets.tests.test_backends import MemoryBackend, make_backend, records
+
+FLUSH_LATENCY = 0.005
+NB_DATASETS = 4
+NB_RECORDS = 500
+
+
+class LatencyBackend(MemoryBackend):
+    '''Pretends every bulk request is a round trip to a remote cluster.'''
+
+    def flush(self, objs, **kw):
+        time.sleep(FLUSH_LATENCY)
+        return len(objs), [], []
+
+    async def aflush(self, objs):
+        await asyncio.sleep(FLUSH_LATENCY)
+        return len(objs), [], []
+
+
+def backends():
+    return [make_backend(LatencyBackend, write_buffer_size=50, flush_workers=4,
+                         stream_flush=True, skip_timestamp=True)
+            for _ in range(NB_DATASETS)]
+
+
+def write_threaded():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(NB_DATASETS) as pool:
+        return list(pool.map(lambda be: be.process_many(records(NB_RECORDS)), backends()))
+
+
+def write_async():
+    async def _write():
+        return await asyncio.gather(*[be.aprocess_many(records(NB_RECORDS))
+                                            for be in backends()])
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_write())
+    finally:
+        loop.close()
+
+
+def test_threaded_process_many(benchmark):
+    results = benchmark.pedantic(write_threaded, rounds=3)
+    assert [it.success for it in results] == [NB_RECORDS]*NB_DATASETS
+
+
+def test_async_process_many(benchmark):
+    results = benchmark.pedantic(write_async, rounds=3)
+    assert [it.success for it in results] == [NB_RECORDS]*NB_DATASETS
@@ -0,0 +1,17 @@
+import os
+import pytest
+
+from datasets.tests.benchmarks.base import run_job, SHAPES, BUFFER_SIZES, NB_RECORDS
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_csv(benchmark, csv_backend, shape, buffer_size):
+    width, _ = SHAPES[shape]
+    params = dict(backend='csv', ns='bench', name='docs.csv', op='create', drop=True,
+                  fields=['uid'] + ['f%s' % ix for ix in range(width)],
+                  write_buffer_size=buffer_size, skip_logs=True)
+
+    result = run_job(benchmark, params, shape)
+    assert result.success == NB_RECORDS
+    assert os.path.getsize(os.path.join(csv_backend, 'bench', 'docs.csv'))
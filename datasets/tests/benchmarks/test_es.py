@@ -0,0 +1,27 @@
+import pytest
+
+from datasets.tests.benchmarks.base import run_job, SHAPES, BUFFER_SIZES, NB_RECORDS
+
+OPS = ['create', 'update:uid', 'upsert:uid', 'delete:uid']
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+@pytest.mark.parametrize('op', OPS)
+def test_es(benchmark, es_backend, op, shape, buffer_size):
+    params = dict(backend='es', ns='bench', name='docs', op=op, pk='uid',
+                  write_buffer_size=buffer_size, skip_logs=True)
+
+    result = run_job(benchmark, params, shape)
+    assert result.success == NB_RECORDS
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('bulk_workers', [1, 4])
+def test_es_bulk_writer(benchmark, es_backend, bulk_workers, compress):
+    params = dict(backend='es', ns='bench', name='docs', op='create', pk='uid',
+                  write_buffer_size=1000, bulk_size=100, bulk_workers=bulk_workers,
+                  bulk_compress=compress, skip_logs=True)
+
+    result = run_job(benchmark, params, 'wide')
+    assert result.success == NB_RECORDS
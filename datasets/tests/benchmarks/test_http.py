@@ -0,0 +1,20 @@
+import json
+import pytest
+from slovar import slovar
+
+import datasets
+from datasets.tests.benchmarks.base import (FakeHTTPHandler, make_records, peak_memory_mb,
+                                            SHAPES, NB_RECORDS, ROUNDS)
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_http_read(benchmark, http_backend, shape):
+    # HTTPBackend is read only, so time fetching and parsing a collection
+    FakeHTTPHandler.payload = json.dumps(list(make_records(NB_RECORDS, *SHAPES[shape]))).encode()
+    api = datasets.get_dataset(slovar(backend='http', ns='NA', name='bench'))
+
+    benchmark.extra_info['peak_memory_mb'] = round(peak_memory_mb(lambda: api.get_collection(_url=http_backend)), 1)
+    result = benchmark.pedantic(api.get_collection, kwargs={'_url': http_backend}, rounds=ROUNDS)
+
+    benchmark.extra_info['docs_per_sec'] = round(NB_RECORDS / benchmark.stats.stats.mean)
+    assert len(result) == NB_RECORDS
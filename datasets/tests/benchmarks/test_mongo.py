@@ -0,0 +1,69 @@
+import pytest
+from slovar import slovar
+
+import datasets
+from datasets.backends import Backend
+from datasets.tests.benchmarks.base import run_job, make_records, SHAPES, BUFFER_SIZES, NB_RECORDS
+
+OPS = ['create', 'update:uid', 'upsert:uid', 'delete:uid']
+
+# value of the seeded documents, gone once they are updated
+STALE = 'stale'
+
+
+def mongo_params(op, buffer_size=1000):
+    return dict(backend='mongo', ns='bench', name='docs', op=op,
+                write_buffer_size=buffer_size, skip_logs=True)
+
+
+def stale(records):
+    for data in records:
+        data = data.flat()
+        yield slovar((key, val if key == 'uid' else STALE) for key, val in data.items()).unflat()
+
+
+def reset(op):
+    def _reset(records):
+        datasets.drop_dataset(slovar(backend='mongo', ns='bench', name='docs'))
+        if op != 'create':
+            Backend(slovar(mongo_params('create')), slovar()).process(stale(records))
+    return _reset
+
+
+def check_target(op, shape):
+    collection = datasets.get_dataset(slovar(backend='mongo', ns='bench', name='docs'))._get_collection()
+
+    if op.startswith('delete'):
+        assert collection.count_documents({}) == 0
+        return
+
+    assert collection.count_documents({}) == NB_RECORDS
+    assert len(collection.distinct('uid')) == NB_RECORDS
+
+    # every seeded field holds the new value
+    for key in next(make_records(1, *SHAPES[shape])).flat():
+        assert collection.count_documents({key: STALE}) == 0
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+@pytest.mark.parametrize('op', OPS)
+def test_mongo(benchmark, mongo_backend, op, shape, buffer_size):
+    run_job(benchmark, mongo_params(op, buffer_size), shape, setup=reset(op))
+    check_target(op, shape)
+
+
+@pytest.mark.parametrize('op', OPS[1:])
+def test_mongo_bulk_write(benchmark, mongo_backend, op):
+    params = mongo_params(op)
+    params['bulk_write'] = True
+    run_job(benchmark, params, 'narrow', setup=reset(op))
+    check_target(op, 'narrow')
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_mongo_raw_create(benchmark, mongo_backend, shape):
+    params = mongo_params('create')
+    params['raw_create'] = True
+    run_job(benchmark, params, shape, setup=reset('create'))
+    check_target('create', shape)
@@ -0,0 +1,15 @@
+import pytest
+
+from datasets.tests.benchmarks.base import run_job, SHAPES, BUFFER_SIZES, NB_RECORDS
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_s3(benchmark, s3_backend, shape, buffer_size):
+    width, _ = SHAPES[shape]
+    params = dict(backend='s3', ns='bench', name='docs.csv', op='create',
+                  fields=['uid'] + ['f%s' % ix for ix in range(width)],
+                  write_buffer_size=buffer_size, skip_logs=True)
+
+    result = run_job(benchmark, params, shape)
+    assert result.success == NB_RECORDS
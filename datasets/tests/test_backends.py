@@ -0,0 +1,738 @@
+import asyncio
+import json
+import logging
+import mock
+import os
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+
+from slovar import slovar
+
+from datasets.backends.base import Base, payload_size
+
+
+class MemoryBackend(Base):
+    def __init__(self, params, job_log=None):
+        self.flushed = []
+        super().__init__(params, job_log)
+
+    def create(self, data):
+        data = self.pre_save(data)
+        self.buffer_append(data)
+
+    def flush(self, objs, **kw):
+        self.flushed.append(list(objs))
+        return len(objs), [], []
+
+
+class SlowBackend(MemoryBackend):
+    def __init__(self, params, job_log=None):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        super().__init__(params, job_log)
+
+    def flush(self, objs, **kw):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        time.sleep(0.02)
+
+        with self._lock:
+            self.in_flight -= 1
+
+        errors = [{'code': 1, 'id': it['id']} for it in objs if it['id'] == '13']
+        return super().flush(objs)[0] - len(errors), errors, []
+
+
+def make_backend(klass=MemoryBackend, **params):
+    params = slovar(params)
+    params.setdefault('name', 'col')
+    params.setdefault('ns', 'test')
+    params.setdefault('op', 'create')
+    params.setdefault('skip_logs', True)
+
+    with mock.patch('datasets.get_dataset'):
+        return klass(params)
+
+
+def records(count, **extra):
+    return (slovar(id=str(ix), value='x'*10, **extra) for ix in range(count))
+
+
+class TestBaseFlush(unittest.TestCase):
+
+    def test_payload_size(self):
+        assert payload_size({'ab': 'xyz', 'c': [1, 'de']}) == 2+3+1+8+2
+
+    def test_process_many_flushes_at_the_end(self):
+        be = make_backend(write_buffer_size=10)
+
+        def _dataset():
+            for data in records(25):
+                #nothing is flushed while input is being read
+                assert not be.flushed
+                yield data
+
+        be.process_many(_dataset())
+        assert [len(it) for it in be.flushed] == [10, 10, 5]
+
+    def test_stream_flush_by_count(self):
+        be = make_backend(write_buffer_size=10, stream_flush=True)
+
+        def _dataset():
+            for ix, data in enumerate(records(25)):
+                assert len(be._buffer) < 10
+                yield data
+
+        be.process_many(_dataset())
+        assert [len(it) for it in be.flushed] == [10, 10, 5]
+        assert not be._buffer
+
+    def test_stream_flush_by_bytes(self):
+        be = make_backend(write_buffer_size=1000, write_buffer_bytes=500,
+                          stream_flush=True, skip_timestamp=True)
+        be.process_many(records(100))
+
+        assert sum(len(it) for it in be.flushed) == 100
+        assert len(be.flushed) > 1
+
+    def test_dry_run_does_not_flush(self):
+        be = make_backend(dry_run=True, stream_flush=True, write_buffer_size=10)
+        be.process_many(records(25))
+        assert not be.flushed
+        assert not be._buffer
+
+
+class TestFlushWorkers(unittest.TestCase):
+
+    def test_concurrent_flushes(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, flush_workers=4,
+                          fail_on_error=False)
+        stats = be.process_many(records(100))
+
+        assert be.max_in_flight > 1
+        assert be.max_in_flight <= 4
+        assert stats == {'total': 100, 'success': 99, 'errors': 1}
+
+    def test_concurrent_flushes_raise(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, flush_workers=4)
+        self.assertRaises(ValueError, be.process_many, records(100))
+        assert not be._flushes
+
+    def test_ordered_backend_uses_single_writer(self):
+        class OrderedBackend(MemoryBackend):
+            _ordered_flush = True
+
+        be = make_backend(OrderedBackend, write_buffer_size=10, flush_workers=4)
+        be.process_many(records(30))
+
+        assert be.flush_workers == 1
+        assert [it[0]['id'] for it in be.flushed] == ['0', '10', '20']
+
+
+class TestSink(unittest.TestCase):
+
+    def test_many_producers(self):
+        be = make_backend(write_buffer_size=50, sink_queue_size=10)
+
+        def produce(offset):
+            for ix in range(100):
+                be.submit(slovar(id='%s-%s' % (offset, ix)))
+
+        producers = [threading.Thread(target=produce, args=(ix,)) for ix in range(4)]
+        for each in producers:
+            each.start()
+        for each in producers:
+            each.join()
+
+        stats = be.close()
+        assert stats.total == stats.success == 400
+        assert len(set(it['id'] for chunk in be.flushed for it in chunk)) == 400
+
+    def test_flushes_when_idle(self):
+        be = make_backend(write_buffer_size=50, sink_flush_interval=0.01)
+        be.submit(slovar(id='1'))
+
+        for _ in range(100):
+            if be.flushed:
+                break
+            time.sleep(0.01)
+
+        assert be.flushed == [[mock.ANY]]
+        be.close()
+
+    def test_sink_error_is_raised(self):
+        be = make_backend(SlowBackend, write_buffer_size=5, sink_queue_size=2)
+
+        with self.assertRaises(ValueError):
+            for data in records(50):
+                be.submit(data)
+            be.close()
+
+        self.assertRaises(ValueError, be.close)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsync(unittest.TestCase):
+
+    def test_async_iterable(self):
+        be = make_backend(write_buffer_size=10, flush_workers=3)
+
+        async def _dataset():
+            for data in records(25):
+                yield data
+
+        stats = run(be.aprocess_many(_dataset()))
+        assert stats.total == stats.success == 25
+        assert sorted(len(it) for it in be.flushed) == [5, 10, 10]
+
+    def test_async_errors(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, flush_workers=3)
+        self.assertRaises(ValueError, run, be.aprocess_many(records(100)))
+
+        be = make_backend(SlowBackend, write_buffer_size=10, fail_on_error=False)
+        stats = run(be.aprocess_many(records(100)))
+        assert stats == {'total': 100, 'success': 99, 'errors': 1}
+
+    def test_async_resume(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        params = dict(write_buffer_size=10, stream_flush=True, job_id='job1', checkpoint='file:%s' % tmpdir)
+
+        be = make_backend(SlowBackend, **params)
+        self.assertRaises(ValueError, run, be.aprocess_many(records(25)))
+
+        be = make_backend(**params)
+        stats = run(be.aprocess_many(records(25)))
+
+        assert [it['id'] for it in be.flushed[0]][:1] == ['10']
+        assert stats == {'total': 25, 'success': 25, 'errors': 0}
+
+    def test_async_skip_filter(self):
+        be = make_backend(TargetBackend, skip_by='id', skip_filter='set')
+
+        with mock.patch.object(be, 'preflight') as preflight:
+            stats = run(be.aprocess_many(records(10)))
+            assert preflight.called
+
+        assert stats.skipped == 5
+        assert be.pk_filter is None
+
+
+class TestPrepareWorkers(unittest.TestCase):
+
+    def test_prepare_in_workers(self):
+        be = make_backend(write_buffer_size=10, prepare_workers=3)
+        stats = be.process_many(records(95))
+
+        assert stats.success == 95
+        # order of the input is kept
+        assert [it['id'] for chunk in be.flushed for it in chunk] == [str(ix) for ix in range(95)]
+        assert all('created_at' in it for chunk in be.flushed for it in chunk)
+
+    def test_prepare_in_workers_streaming(self):
+        be = make_backend(write_buffer_size=10, prepare_workers=2, stream_flush=True)
+        be.process_many(records(45))
+        assert [len(it) for it in be.flushed] == [10, 10, 10, 10, 5]
+
+    def test_cannot_prepare_in_workers(self):
+        class InlineBackend(MemoryBackend):
+            def can_prepare_in_workers(self):
+                return False
+
+        be = make_backend(InlineBackend, prepare_workers=2)
+        assert be.prepare_workers == 0
+
+    def test_forked_before_start_job(self):
+        be = make_backend(write_buffer_size=10, prepare_workers=2)
+
+        calls = mock.Mock()
+
+        with mock.patch.object(be, 'open_prepare_pool', wraps=be.open_prepare_pool) as open_pool, \
+                mock.patch.object(be, 'start_job') as start_job:
+            calls.attach_mock(open_pool, 'open_prepare_pool')
+            calls.attach_mock(start_job, 'start_job')
+            be.process_many(records(25))
+
+        assert [it[0] for it in calls.mock_calls] == ['open_prepare_pool', 'start_job']
+
+    def test_worker_metrics(self):
+        be = make_backend(write_buffer_size=10, prepare_workers=2, metrics=True)
+        stats = be.process_many(records(25))
+
+        assert stats.metrics.stages.process['count'] == 25
+        assert stats.metrics.stages.pre_save['count'] == 25
+
+
+class TestDefaults(unittest.TestCase):
+
+    def test_static_defaults(self):
+        be = make_backend(default={'a': {'b': 1, 'c': [1]}, 'd__asint': '5', 'e': 'x'})
+
+        data = be.add_defaults(slovar(a={'b': 2}, e='y'))
+        assert data == {'a': {'b': 2, 'c': [1]}, 'd': 5, 'e': 'y'}
+
+        data['a']['c'].append(2)
+        assert be.add_defaults(slovar())['a']['c'] == [1]
+
+    def test_dynamic_defaults(self):
+        be = make_backend(default={'oid': '__OID__', 'ts': {'now': '__NOW__'}})
+
+        data1 = be.add_defaults(slovar())
+        data2 = be.add_defaults(slovar(oid='1'))
+
+        assert data1.oid != data2.oid
+        assert data2.oid == '1'
+        assert data1.ts.now <= data2.ts.now
+
+    def test_no_defaults(self):
+        be = make_backend()
+        data = slovar(a=1)
+        assert be.add_defaults(data) is data
+
+
+class TestColumnar(unittest.TestCase):
+
+    def rows_and_columns(self):
+        rows = [slovar(id=str(ix), a=ix, b='' if ix % 2 else 'x', c='null', d=ix) for ix in range(25)]
+        columns = {name: [it[name] for it in rows] for name in rows[0]}
+        return rows, columns
+
+    def flushed_without_timestamps(self, be):
+        return [it.pop_many(['created_at', 'updated_at']) and it
+                    for chunk in be.flushed for it in chunk]
+
+    def test_batches_match_rows(self):
+        params = dict(write_buffer_size=10, fields=['id', 'a', 'b', 'c'], pop_empty=True)
+        rows, columns = self.rows_and_columns()
+
+        be_rows = make_backend(**params)
+        be_rows.process_many(rows)
+
+        be_cols = make_backend(**params)
+        stats = be_cols.process_batches([columns])
+
+        assert stats.success == 25
+        assert self.flushed_without_timestamps(be_cols) == self.flushed_without_timestamps(be_rows)
+        assert be_cols.flushed[0][1] == {'id': '1', 'a': 1, 'c': None}
+
+    def test_numpy_batches(self):
+        import numpy as np
+
+        be = make_backend(write_buffer_size=10, remove_fields=['b'])
+        be.process_batches([{'id': np.array(['1', '2']), 'a': np.arange(2), 'b': np.ones(2)}])
+
+        assert [(it['id'], it['a']) for it in be.flushed[0]] == [('1', 0), ('2', 1)]
+        assert 'b' not in be.flushed[0][0]
+
+    def test_build_pk(self):
+        be = make_backend(pk='b,a')
+        assert be.build_pk(slovar(a=1, b='x', c=2)) == ('a:b', '1:x')
+        assert be.build_pk(slovar(a={'x': 1}, b='x')) == ('a.x:b', '1:x')
+        self.assertRaises(KeyError, be.build_pk, slovar(c=1))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_metrics_off(self):
+        be = make_backend()
+        stats = be.process_many(records(5))
+        assert 'metrics' not in stats
+
+    def test_metrics_in_job_result(self):
+        exported = []
+        be = make_backend(SlowBackend, metrics=True, write_buffer_size=10, fail_on_error=False)
+        be.metrics.exporters.append(exported.append)
+
+        stats = be.process_many(records(25))
+
+        assert stats.metrics.stages.process['count'] == 25
+        assert stats.metrics.stages.pre_save['count'] == 25
+        assert stats.metrics.stages.flush['count'] == 3
+        assert stats.metrics.stages.init['count'] == 1
+        assert stats.metrics.events == {'written': 24, 'errors': 1}
+        assert stats.metrics.bytes['flush'] > 0
+        assert exported == [be.metrics]
+
+    def test_prometheus(self):
+        be = make_backend(metrics=True, write_buffer_size=10)
+        be.process_many(records(25))
+
+        text = be.metrics.to_prometheus()
+        assert '# TYPE datasets_stage_seconds histogram' in text
+        assert 'datasets_stage_seconds_count{backend="MemoryBackend",name="col",ns="test",op="create",stage="flush"} 3' in text
+        assert 'le="+Inf",name="col",ns="test",op="create",stage="process"} 25' in text
+        assert 'datasets_events_total{backend="MemoryBackend",event="written",name="col",ns="test",op="create"} 25' in text
+
+
+class TestActionLogging(unittest.TestCase):
+
+    def test_level_is_off(self):
+        be = make_backend()
+        logger = mock.Mock(isEnabledFor=mock.Mock(return_value=False))
+
+        assert not any(be.should_log_action('create', logger) for _ in range(10))
+        logger.isEnabledFor.assert_called_with(logging.DEBUG)
+        assert not be._action_counts
+
+    def test_dry_run_checks_warning_level(self):
+        be = make_backend(dry_run=True)
+        logger = mock.Mock(isEnabledFor=mock.Mock(return_value=True))
+
+        be.should_log_action('create', logger)
+        logger.isEnabledFor.assert_called_with(logging.WARNING)
+
+    def test_sampling(self):
+        logger = mock.Mock(isEnabledFor=mock.Mock(return_value=True))
+
+        be = make_backend(log_every=3)
+        assert [be.should_log_action('create', logger) for _ in range(7)] == \
+                    [True, False, False, True, False, False, True]
+
+        be = make_backend(log_first=2)
+        assert [be.should_log_action('update', logger) for _ in range(4)] == [True, True, False, False]
+        assert be.should_log_action('delete', logger)
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'Job.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_logs(self):
+        with open(self.path) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_no_sink(self):
+        be = make_backend()
+        be.process_many(records(5))
+        assert be.log_sink is None
+        assert not be._log_buffer
+
+    def test_file_per_record(self):
+        be = make_backend(write_buffer_size=10, log_sink='file', log_file=self.path,
+                          log_batch_size=7, pk='id')
+        be.job_log = slovar(job={'uid': 'j1'})
+        stats = be.process_many(records(25))
+
+        logs = self.read_logs()
+        assert stats.logs == {'total': 25, 'written': 25, 'errors': 0}
+        assert sorted(int(it['id']) for it in logs if 'target_pk_field' in it) == list(range(25))
+        assert all(it['job'] == {'uid': 'j1'} for it in logs)
+
+    def test_file_summary(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, log_sink='file', log_file=self.path,
+                          log_mode='summary', fail_on_error=False)
+        be.process_many(records(25))
+
+        logs = self.read_logs()
+        assert [it['target_chunk'] for it in logs] == [
+            {'total': 10, 'success': 10, 'errors': 0},
+            {'total': 10, 'success': 9, 'errors': 1},
+            {'total': 5, 'success': 5, 'errors': 0},
+        ]
+
+    def test_summary_only(self):
+        be = make_backend(write_buffer_size=10, log_sink='summary')
+        stats = be.process_many(records(25))
+
+        assert be.params.log_mode == 'summary'
+        assert stats.logs == {'chunks': 3, 'total': 25, 'success': 25, 'errors': 0}
+
+    def test_write_errors(self):
+        be = make_backend(log_sink='file', log_file=os.path.join(self.tmpdir, 'missing', 'job.log'))
+        self.assertRaises(ValueError, be.process_many, records(5))
+
+    def test_es_retries_back_off(self):
+        from datasets.joblog import ESLogSink
+
+        sink = ESLogSink('logs')
+        with mock.patch('prf.es.ES') as es, mock.patch('datasets.joblog.time.sleep') as sleep:
+            es.version.major = 7
+            es.flush.side_effect = [(1, [], ['b']), (0, [], ['b']), (1, [], [])]
+            assert sink.write([slovar(n=1), slovar(n=2)]) == (2, [])
+
+        delays = [it[0][0] for it in sleep.call_args_list]
+        assert len(delays) == 2
+        assert 0.25 <= delays[0] <= 0.5 and 0.5 <= delays[1] <= 1.0
+
+    def test_bad_sink(self):
+        self.assertRaises(ValueError, make_backend, log_sink='kafka', log_ds='x')
+        self.assertRaises(ValueError, make_backend, log_sink='mongo', log_ds='x')
+        self.assertRaises(ValueError, make_backend, log_mode='detailed')
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.params = dict(write_buffer_size=10, stream_flush=True, job_id='job1',
+                           checkpoint='file:%s' % self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        from datasets.checkpoint import FileCheckpoints
+        return FileCheckpoints(self.tmpdir).load('job1')
+
+    def test_resume_after_failure(self):
+        be = make_backend(SlowBackend, **self.params)
+        self.assertRaises(ValueError, be.process_many, records(25))
+
+        state = self.load()
+        assert state.position == 10
+        assert state.total == state.success == 10
+        assert not state.done
+
+        be = make_backend(**self.params)
+        stats = be.process_many(records(25))
+
+        assert [it['id'] for it in be.flushed[0]][:1] == ['10']
+        assert stats == {'total': 25, 'success': 25, 'errors': 0}
+        assert self.load().done
+        assert self.load().position == 25
+
+    def test_concurrent_flushes(self):
+        be = make_backend(SlowBackend, flush_workers=4, fail_on_error=False, **self.params)
+        be.process_many(records(100))
+
+        state = self.load()
+        assert state.position == 100
+        assert (state.total, state.success, state.errors) == (100, 99, 1)
+
+    def test_prepare_workers(self):
+        be = make_backend(prepare_workers=2, **self.params)
+        be.process_many(records(45))
+        assert self.load().position == 45
+
+    def test_implies_stream_flush(self):
+        params = dict(self.params, stream_flush=False)
+        be = make_backend(SlowBackend, **params)
+        assert be.params.stream_flush
+
+        self.assertRaises(ValueError, be.process_many, records(25))
+        assert self.load().position == 10
+
+    def test_not_with_sink(self):
+        be = make_backend(**self.params)
+        self.assertRaises(ValueError, be.submit, slovar(id='1'))
+
+    def test_needs_job_id(self):
+        self.assertRaises(ValueError, make_backend, checkpoint='file:%s' % self.tmpdir)
+        self.assertRaises(ValueError, make_backend, job_id='x', checkpoint='redis:x')
+
+
+class TargetBackend(MemoryBackend):
+    existing = ['0', '1', '2', '3', '4']
+
+    def create(self, data):
+        if self._use_pk_filter and self.skip_known(self.skip_key(data)):
+            return
+        data = self.pre_save(data)
+        self.buffer_append(data)
+
+    def count_target(self):
+        return len(self.existing)
+
+    def iter_target_keys(self):
+        return iter(self.existing)
+
+
+class TestSkipFilter(unittest.TestCase):
+
+    def run_job(self, skip_filter, **params):
+        be = make_backend(TargetBackend, skip_by='id', skip_filter=skip_filter, **params)
+        stats = be.process_many(list(records(10)) + list(records(3)))
+        return be, stats
+
+    def test_set(self):
+        be, stats = self.run_job('set')
+
+        assert [it['id'] for it in be.flushed[0]] == ['5', '6', '7', '8', '9']
+        assert stats.skipped == 8
+        assert stats.total == 5
+        assert be.pk_filter is None
+
+    def test_bloom(self):
+        be, stats = self.run_job('bloom:0.0001')
+        assert [it['id'] for it in be.flushed[0]] == ['5', '6', '7', '8', '9']
+
+    def test_disk(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            be, stats = self.run_job('disk:%s' % os.path.join(tmpdir, 'pks'), prepare_workers=2)
+            assert be.prepare_workers == 0
+            assert stats.skipped == 8
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_not_in_workers(self):
+        be, stats = self.run_job('set', prepare_workers=2)
+        assert be.prepare_workers == 0
+        assert stats.skipped == 8
+
+    def test_only_for_inserts(self):
+        be = make_backend(TargetBackend, skip_filter='set')
+        assert not be._use_pk_filter
+        assert 'skipped' not in be.process_many(records(10))
+
+    def test_bloom_false_positives(self):
+        from datasets.pkfilter import BloomFilter
+
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for ix in range(10000):
+            bloom.add('in-%s' % ix)
+
+        assert all('in-%s' % ix in bloom for ix in range(10000))
+        assert sum('out-%s' % ix in bloom for ix in range(10000)) < 200
+
+
+class TestChunkSizing(unittest.TestCase):
+
+    def test_byte_chunks(self):
+        from datasets.sizing import byte_chunks
+
+        items = list('abcdef')
+        sizes = [1, 1, 5, 1, 1, 10]
+
+        assert list(byte_chunks(items, sizes, 4, max_bytes=6)) == [
+            (['a', 'b'], 2), (['c', 'd'], 6), (['e'], 1), (['f'], 10)]
+        assert [it for it, _ in byte_chunks(items, sizes, 4)] == [list('abcd'), list('ef')]
+
+    def test_sizer(self):
+        from datasets.sizing import ChunkSizer
+
+        sizer = ChunkSizer(100, 10, 1000, target_latency=1.0)
+        sizer.observe(100, 0, 0.1)
+        assert sizer() == 200
+
+        sizer.observe(200, 0, 4.0)
+        assert sizer() == 125
+
+        sizer = ChunkSizer(100, 10, 1000, target_latency=1.0, target_bytes=1000)
+        sizer.observe(100, 4000, 0.1)
+        assert sizer() == 62
+
+        sizer.observe(62, 1000, 0.1, throttled=True)
+        assert sizer() == 31
+
+    def test_flush_max_bytes(self):
+        be = make_backend(write_buffer_size=100, flush_max_bytes=200, skip_timestamp=True)
+        stats = be.process_many(records(50))
+
+        assert stats.success == 50
+        assert max(sum(payload_size(it) for it in chunk) for chunk in be.flushed) <= 200
+        assert len(be.flushed) > 1
+
+    def test_adaptive(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, adaptive_flush=True,
+                          flush_target_latency=0.1, fail_on_error=False)
+        be.process_many(records(300))
+
+        sizes = [len(it) for it in be.flushed]
+        assert sizes[0] == 10
+        assert max(sizes) > 10
+        assert sum(sizes) == 300
+
+    def test_adaptive_streaming(self):
+        be = make_backend(SlowBackend, write_buffer_size=10, adaptive_flush=True, stream_flush=True,
+                          flush_target_latency=0.1, fail_on_error=False)
+        be.process_many(records(300))
+
+        sizes = [len(it) for it in be.flushed]
+        assert sizes[0] == 10
+        assert max(sizes[:-1]) > 10
+        assert sum(sizes) == 300
+
+
+class ThrottledBackend(MemoryBackend):
+    '''
+        Sends records back for retry `throttle` times each.
+    '''
+    throttle = 1
+
+    def __init__(self, params, job_log=None):
+        self.seen = {}
+        super().__init__(params, job_log)
+
+    def flush(self, objs, **kw):
+        retries = []
+        for it in objs:
+            self.seen[it['id']] = self.seen.get(it['id'], 0) + 1
+            if int(it['id']) % 3 == 0 and self.seen[it['id']] <= self.throttle:
+                retries.append(it)
+
+        self.flushed.append([it for it in objs if it not in retries])
+        return len(objs) - len(retries), [], retries
+
+
+class TestRetries(unittest.TestCase):
+    params = dict(write_buffer_size=10, retry_backoff=0.01, skip_timestamp=True)
+
+    def flushed_ids(self, be):
+        return sorted(int(it['id']) for chunk in be.flushed for it in chunk)
+
+    def test_requeued(self):
+        be = make_backend(ThrottledBackend, stream_flush=True, **self.params)
+        stats = be.process_many(records(50))
+
+        assert stats == {'total': 50, 'success': 50, 'errors': 0}
+        assert self.flushed_ids(be) == list(range(50))
+        assert be.seen['3'] == 2
+        assert not be._retry_pending
+
+    def test_retries_exhausted(self):
+        class AlwaysThrottled(ThrottledBackend):
+            throttle = 100
+
+        be = make_backend(AlwaysThrottled, fail_on_error=False, flush_retries=2, **self.params)
+        stats = be.process_many(records(30))
+
+        assert stats == {'total': 30, 'success': 20, 'errors': 10}
+        assert be.seen['3'] == 3
+
+        be = make_backend(AlwaysThrottled, **self.params)
+        self.assertRaises(ValueError, be.process_many, records(30))
+
+    def test_flush_workers(self):
+        be = make_backend(ThrottledBackend, flush_workers=3, stream_flush=True, **self.params)
+        stats = be.process_many(records(100))
+
+        assert stats.success == stats.total == 100
+        assert self.flushed_ids(be) == list(range(100))
+
+    def test_checkpoint_waits_for_retries(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            from datasets.checkpoint import FileCheckpoints
+
+            be = make_backend(ThrottledBackend, job_id='j', checkpoint='file:%s' % tmpdir, **self.params)
+            be.process_many(records(10))
+            state = FileCheckpoints(tmpdir).load('j')
+            assert (state.position, state.total, state.success, state.done) == (10, 10, 10, True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_async(self):
+        be = make_backend(ThrottledBackend, **self.params)
+        stats = run(be.aprocess_many(records(30)))
+
+        assert stats == {'total': 30, 'success': 30, 'errors': 0}
+        assert self.flushed_ids(be) == list(range(30))
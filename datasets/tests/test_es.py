@@ -0,0 +1,149 @@
+import json
+import mock
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+from elasticsearch import Elasticsearch, ConnectionError, NotFoundError
+from slovar import slovar
+
+from datasets import eswriter
+from datasets.backends.es import ESBackend, field_mapping, is_exact_field
+from datasets.eswriter import BulkWriter, dumps
+from datasets.tests.benchmarks.base import serve, FakeESHandler
+
+
+class RecordingESHandler(FakeESHandler):
+    requests = []
+
+    def do_POST(self):
+        self.requests.append(dict(self.headers))
+        super().do_POST()
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = serve(RecordingESHandler)
+        cls.client = Elasticsearch(['http://127.0.0.1:%s' % cls.server.server_port])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        RecordingESHandler.requests = []
+
+    def actions(self, nb):
+        return [slovar(_op_type='index', _index='docs', _id=str(ix), _source=slovar(n=ix)) for ix in range(nb)]
+
+    def test_dumps(self):
+        doc = slovar(at=datetime(2020, 1, 2, 3, 4, 5), price=Decimal('1.5'), name='é', nested={1: [True]})
+        expected = {'at': '2020-01-02T03:04:05', 'price': 1.5, 'name': 'é', 'nested': {'1': [True]}}
+
+        assert json.loads(dumps(doc)) == expected
+        with mock.patch.object(eswriter, 'orjson', None):
+            assert json.loads(dumps(doc)) == expected
+
+        assert json.loads(dumps({'big': 2**70})) == {'big': 2**70}
+
+    def test_workers(self):
+        writer = BulkWriter(self.client, workers=3, bulk_size=10)
+        try:
+            assert writer.bulk(self.actions(95)) == (95, [])
+        finally:
+            writer.close()
+
+        # 3 shards of ~32 actions, in requests of 10
+        assert 10 <= len(RecordingESHandler.requests) <= 12
+
+    def test_shards_by_id(self):
+        writer = BulkWriter(self.client, workers=4, bulk_size=2)
+        actions = self.actions(20) + [slovar(_op_type='delete', _index='docs', _id='3')]
+
+        with mock.patch.object(writer, 'write', return_value=(0, [])) as write:
+            writer.bulk(actions)
+        writer.close()
+
+        shard, = [it[0][0] for it in write.call_args_list if any(a['_id'] == '3' for a in it[0][0])]
+        assert [it['_op_type'] for it in shard if it['_id'] == '3'] == ['index', 'delete']
+
+    def test_compress(self):
+        writer = BulkWriter(self.client, compress=True)
+        assert writer.bulk(self.actions(5)) == (5, [])
+
+        headers = {k.lower(): v for k, v in RecordingESHandler.requests[0].items()}
+        assert headers['content-encoding'] == 'gzip'
+
+    def test_transport(self):
+        writer = BulkWriter(self.client)
+
+        with mock.patch.object(self.client.transport, 'perform_request',
+                               wraps=self.client.transport.perform_request) as perform_request:
+            assert writer.bulk(self.actions(3)) == (3, [])
+
+        assert perform_request.call_args[0] == ('POST', '/_bulk')
+
+    def test_compress_fallback(self):
+        writer = BulkWriter(self.client, compress=True)
+
+        with mock.patch.object(writer, 'send_compressed', side_effect=ConnectionError('N/A', 'refused', None)):
+            assert writer.bulk(self.actions(3)) == (3, [])
+
+        headers = {k.lower(): v for k, v in RecordingESHandler.requests[0].items()}
+        assert 'content-encoding' not in headers
+        assert writer.compress
+
+    def test_request_failed(self):
+        writer = BulkWriter(self.client)
+        actions = self.actions(2) + [slovar(_op_type='delete', _index='docs', _id='9')]
+
+        with mock.patch.object(writer, 'send', side_effect=ConnectionError('N/A', 'refused', None)):
+            success, errors = writer.bulk(actions)
+
+        assert success == 0
+        assert [it['index']['status'] for it in errors[:2]] == ['N/A', 'N/A']
+        assert errors[0]['index']['_id'] == '0' and errors[0]['index']['data'] == {'n': 0}
+        assert 'data' not in errors[2]['delete']
+
+
+class TestIndexPolicy(unittest.TestCase):
+    mappings = {'notanalyzed': {'properties': {
+        'uid': {'type': 'keyword'},
+        'name': {'type': 'text', 'fields': {'raw': {'type': 'keyword'}}},
+        'body': {'type': 'text'},
+        'old': {'type': 'string', 'index': 'not_analyzed'},
+        'user': {'properties': {'id': {'type': 'long'}, 'bio': {'type': 'text'}}},
+    }}}
+
+    def test_field_mapping(self):
+        assert field_mapping(self.mappings, 'user.id') == {'type': 'long'}
+        # typeless, ES >= 7
+        assert field_mapping(self.mappings['notanalyzed'], 'uid') == {'type': 'keyword'}
+        assert field_mapping(self.mappings, 'missing') is None
+        assert field_mapping(self.mappings, 'user.missing') is None
+
+    def test_is_exact_field(self):
+        for field in ['uid', 'name', 'old', 'user.id']:
+            assert is_exact_field(self.mappings, field), field
+
+        for field in ['body', 'user.bio', 'missing']:
+            assert not is_exact_field(self.mappings, field), field
+
+    def test_op_index_status(self):
+        be = mock.Mock(spec=ESBackend)
+        be.klass = mock.Mock(index='bench.docs')
+        be.op_fields.return_value = ['uid', 'body']
+
+        with mock.patch('datasets.backends.es.ES') as es:
+            es.api.indices.get_mapping.return_value = {'bench.docs': {'mappings': self.mappings}}
+            assert ESBackend.op_index_status(be) == \
+                        (False, "['body'] not mapped as keyword, term lookups will miss or scan")
+
+            be.op_fields.return_value = ['uid']
+            assert ESBackend.op_index_status(be) == (True, None)
+
+            # a dry run does not create the index
+            es.api.indices.get_mapping.side_effect = NotFoundError(404, 'index_not_found_exception', {})
+            assert ESBackend.op_index_status(be) == (False, 'index `bench.docs` is missing')
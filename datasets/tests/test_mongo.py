@@ -0,0 +1,543 @@
+import mock
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+import pytest
+from slovar import slovar
+
+import datasets
+from datasets.backends import mongo as mongo_be
+from prf.mongodb import mongo_disconnect
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class MongoTestCase(unittest.TestCase):
+    namespaces = ['dstest', 'dstest2']
+
+    def setUp(self):
+        self._settings = datasets.Settings
+        datasets.Settings = slovar({'mongodb.host': 'localhost', 'mongodb.db': 'dstest'})
+
+        patcher = mock.patch('mongoengine.connection.MongoClient', mongomock.MongoClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for ns in self.namespaces:
+            mongo_disconnect(ns)
+        mongo_be.invalidate_documents()
+        datasets.Settings = self._settings
+
+    def ds(self, name, ns='dstest'):
+        return slovar(backend='mongo', ns=ns, name=name)
+
+
+class TestDocumentRegistry(MongoTestCase):
+
+    def test_reused(self):
+        kls = datasets.get_dataset(self.ds('col1'), define=True)
+        assert datasets.get_dataset(self.ds('col1'), define=True) is kls
+        assert datasets.get_dataset(self.ds('col1', ns='dstest2')) is not kls
+
+    def test_no_reconnect(self):
+        datasets.get_dataset(self.ds('col1'))
+
+        with mock.patch.object(mongo_be, 'connect_namespace') as connect:
+            datasets.get_dataset(self.ds('col1'), define=True)
+            datasets.get_dataset(self.ds('col2'), define=True)
+            assert not connect.called
+
+    def test_invalidated(self):
+        kls = datasets.get_dataset(self.ds('col1'))
+        kls(name='x').save()
+
+        datasets.drop_dataset(self.ds('col1'))
+        kls2 = datasets.get_dataset(self.ds('col1'))
+        assert kls2 is not kls
+        assert kls2.objects.count() == 0
+
+        kls2.unregister()
+        assert datasets.get_dataset(self.ds('col1')) is not kls2
+
+    def test_disconnected(self):
+        kls = datasets.get_dataset(self.ds('col1'))
+        mongo_disconnect('dstest')
+
+        kls2 = datasets.get_dataset(self.ds('col1'))
+        assert kls2 is not kls
+        assert mongo_be.is_connected('dstest')
+
+
+class TestSharedClient(MongoTestCase):
+
+    def test_shared(self):
+        mongo_be.connect_namespace(datasets.Settings, 'dstest')
+        mongo_be.connect_namespace(datasets.Settings, 'dstest2')
+
+        client = mongo_be.mongo.connection.get_connection('dstest')
+        assert mongo_be.mongo.connection.get_connection('dstest2') is client
+        assert mongo_be.mongo.connection.get_db('dstest2').name == 'dstest2'
+
+    def test_pool_options(self):
+        datasets.Settings.update({'mongodb.max_pool_size': '20', 'mongodb.max_idle_time_ms': 60000})
+
+        with mock.patch('mongoengine.connection.MongoClient') as client_cls:
+            mongo_be.connect_namespace(datasets.Settings, 'dstest')
+            mongo_be.connect_namespace(datasets.Settings, 'dstest2')
+
+        client_cls.assert_called_once_with('localhost', 27017, connect=False,
+                                           maxPoolSize=20, maxIdleTimeMS=60000)
+
+    def test_disconnect_namespace(self):
+        mongo_be.connect_namespace(datasets.Settings, 'dstest')
+        mongo_be.connect_namespace(datasets.Settings, 'dstest2')
+        client = mongo_be.mongo.connection.get_connection('dstest')
+
+        mongo_be.disconnect_namespace('dstest')
+        assert not mongo_be.is_connected('dstest')
+        assert mongo_be.mongo.connection.get_connection('dstest2') is client
+
+        mongo_be.disconnect_namespace('dstest2')
+        mongo_be.connect_namespace(datasets.Settings, 'dstest')
+        assert mongo_be.mongo.connection.get_connection('dstest') is not client
+
+    def test_registry_guard(self):
+        # what the shared clients rely on in mongoengine
+        assert isinstance(mongo_be.mongoengine_registry('_connections'), dict)
+        assert isinstance(mongo_be.mongoengine_registry('_connection_settings'), dict)
+
+        with mock.patch.object(mongo_be.mongo.connection, '_connections', None, create=True):
+            with pytest.raises(RuntimeError):
+                mongo_be.connect_namespace(datasets.Settings, 'dstest')
+
+
+class TestCatalog(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mongo_be.catalog.refresh()
+
+    def test_cached(self):
+        kls = datasets.get_dataset(self.ds('col1'))
+        kls(name='x').save()
+        assert ['dstest', 'col1', 'col1'] in mongo_be.get_dataset_names()
+
+        mongo_be.mongo.connection.get_db('dstest').create_collection('col2')
+        assert ['dstest', 'col2', 'col2'] not in mongo_be.get_dataset_names()
+
+        mongo_be.refresh_catalog('dstest')
+        assert ['dstest', 'col2', 'col2'] in mongo_be.get_dataset_names()
+
+    def test_meta(self):
+        kls = datasets.get_dataset(self.ds('col1'))
+        kls(name='x').save()
+        kls._get_collection().create_index('name')
+
+        meta = datasets.get_dataset_meta(self.ds('col1'))
+        assert [ix.fields for ix in meta.indexes] == [['_id'], ['name']]
+
+        with mock.patch.object(mongo_be.mongo.connection, 'get_db') as get_db:
+            assert datasets.get_dataset_meta(self.ds('col1')) == meta
+            assert not get_db.called
+
+        datasets.drop_dataset(self.ds('col1'))
+        assert datasets.get_dataset_meta(self.ds('col1')) == {}
+
+    def test_after_write(self):
+        ds = self.ds('col3')
+        assert datasets.get_dataset_meta(ds) == {}
+
+        params = ds.update_with({'op': 'create', 'skip_logs': True})
+        mongo_be.MONGOBackend(params, slovar()).process_many([slovar(name='x')])
+
+        assert datasets.get_dataset_meta(ds).collection == 'col3'
+
+    def test_expired(self):
+        calls = []
+        catalog = mongo_be.Catalog(ttl=0)
+
+        catalog.get(('names', 'x'), lambda: calls.append(1))
+        catalog.get(('names', 'x'), lambda: calls.append(1))
+        assert len(calls) == 2
+
+    def test_get_many(self):
+        catalog = mongo_be.Catalog()
+        values = catalog.get_many([('names', ns) for ns in 'abc'], lambda key: key[1]*2)
+        assert values == {('names', 'a'): 'aa', ('names', 'b'): 'bb', ('names', 'c'): 'cc'}
+
+        catalog.refresh('names', 'b')
+        fetch = mock.Mock(return_value='x')
+        assert catalog.get_many([('names', 'a'), ('names', 'b')], fetch)[('names', 'b')] == 'x'
+        fetch.assert_called_once_with(('names', 'b'))
+
+
+class TestPrefetchTargets(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        kls = datasets.get_dataset(self.ds('col1'))
+        for uid in [1, 1, 2]:
+            kls(uid=uid, name='x').save()
+        self.klass = kls
+
+    def backend(self, op, **params):
+        params = slovar(backend='mongo', ns='dstest', name='col1', op=op, bulk_write=True,
+                        fail_on_error=False, write_buffer_size=10, **params)
+        return mongo_be.MONGOBackend(params, slovar())
+
+    def records(self, *uids):
+        return [slovar(uid=uid, name='y') for uid in uids]
+
+    def test_multiple(self):
+        be = self.backend('update:uid')
+
+        with mock.patch.object(be.klass._get_collection().__class__, 'find',
+                               wraps=be.klass._get_collection().find) as find:
+            result = be.process_many(self.records(1, 3))
+            assert find.call_count == 1
+
+        assert result.success == 1 and result.errors == 1
+        assert self.klass.objects(name='y').count() == 0
+
+    def test_delete_not_found(self):
+        be = self.backend('delete:uid')
+
+        with mock.patch.object(be, 'log_not_found') as not_found:
+            result = be.process_many(self.records(2, 3))
+            assert not_found.call_count == 1
+
+        assert result.success == 2
+        assert self.klass.objects.count() == 2
+
+    def test_not_prefetched(self):
+        be = self.backend('update:uid', prefetch_targets=False)
+        result = be.process_many(self.records(1, 2))
+
+        assert result.success == 1 and result.errors == 1
+        assert self.klass.objects(name='y').count() == 1
+
+        be = self.backend('delete:uid', prefetch_targets=False)
+        with mock.patch.object(be, 'log_not_found') as not_found:
+            be.process_many(self.records(3))
+            assert not_found.call_count == 1
+
+    def test_query(self):
+        be = self.backend('delete:uid')
+        ops = [mongo_be.DeleteMany({'uid': 1}), mongo_be.DeleteMany({'uid': 2})]
+        assert be.targets_query(ops) == ({'uid': {'$in': [1, 2]}}, {'uid': 1, '_id': 1})
+
+        assert be.targets_query([mongo_be.DeleteMany({'uid': {'$gt': 1}})]) is None
+        assert self.backend('update:uid', update_multi=True).targets_query(ops) is None
+
+
+class TestBulkWrite(MongoTestCase):
+
+    def backend(self, op, **params):
+        params = slovar(backend='mongo', ns='dstest', name='col1', op=op, bulk_write=True,
+                        skip_logs=True, skip_timestamp=True, **params)
+        return mongo_be.MONGOBackend(params, slovar())
+
+    def test_build_filter(self):
+        be = self.backend('update:uid')
+
+        assert be.build_filter(slovar(uid=1, _limit=-1)) == {'uid': 1}
+        assert be.build_filter(slovar(uid__in=[1, 2])) == {'uid': {'$in': [1, 2]}}
+        assert be.build_filter(slovar(id='5f0c6e0b1c9d440000a1b2c3')) == \
+                    {'_id': mongo_be.ObjectId('5f0c6e0b1c9d440000a1b2c3')}
+
+    def test_buffer_update(self):
+        be = self.backend('update:uid')
+        be.buffer_update(slovar(uid=1, name='y', n=2))
+
+        op, = be._buffer
+        assert isinstance(op, mongo_be.UpdateOne)
+        assert op._filter == {'uid': 1}
+        assert (op._doc['$set']['name'], op._doc['$set']['n']) == ('y', 2)
+        assert not op._upsert
+
+    def test_buffer_upsert_multi(self):
+        be = self.backend('upsert:uid', update_multi=True, remove_fields=['old'])
+        be.buffer_update(slovar(uid=1, name='y'), upsert=True)
+
+        op, = be._buffer
+        assert isinstance(op, mongo_be.UpdateMany)
+        assert op._upsert
+        assert op._doc['$set']['name'] == 'y'
+        assert op._doc['$unset'] == {'old': 1}
+
+
+class TestRawCreate(MongoTestCase):
+
+    def backend(self, **params):
+        params = slovar(backend='mongo', ns='dstest', name='col1', op='create', raw_create=True,
+                        skip_logs=True, **params)
+        return mongo_be.MONGOBackend(params, slovar())
+
+    def collection(self):
+        return datasets.get_dataset(self.ds('col1'))._get_collection()
+
+    def test_ids(self):
+        oid = mongo_be.ObjectId()
+        stats = self.backend().process_many([
+            slovar(id=str(oid), n=1), slovar(id='13', n=2), slovar(id='uid-5', n=3), slovar(id=7, n=4),
+        ])
+
+        assert stats.success == 4
+        assert {it['n']: it['_id'] for it in self.collection().find()} == {1: oid, 2: '13', 3: 'uid-5', 4: 7}
+
+    def test_reserved_operators(self):
+        self.backend().process_many([slovar(id='a', name='x', exists='yes', ne=1)])
+
+        doc = self.collection().find_one({'_id': 'a'})
+        assert doc['name'] == 'x'
+        assert 'exists' not in doc and 'ne' not in doc
+
+    def test_duplicate_id(self):
+        self.collection().insert_one({'_id': 'a'})
+
+        stats = self.backend(fail_on_error=False).process_many([slovar(id='a'), slovar(id='b')])
+        assert stats.success == 1 and stats.errors == 1
+
+        with pytest.raises(ValueError):
+            self.backend().process_many([slovar(id='b')])
+
+
+class TestSkipFilter(MongoTestCase):
+
+    def test_skipped_before_pre_save(self):
+        klass = datasets.get_dataset(self.ds('col1'))
+        for uid in [1, 2]:
+            klass(uid=uid).save()
+
+        params = slovar(backend='mongo', ns='dstest', name='col1', op='create',
+                        skip_by='uid', skip_filter='set')
+        be = mongo_be.MONGOBackend(params, slovar())
+
+        with mock.patch.object(be, 'pre_save', wraps=be.pre_save) as pre_save:
+            stats = be.process_many([slovar(uid=it) for it in [1, 2, 3]])
+
+        assert pre_save.call_count == 1
+        assert stats.skipped == 2
+        assert klass.objects.count() == 3
+
+
+class TestIndexPolicy(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.klass = datasets.get_dataset(self.ds('col1'))
+        self.klass(uid=1, name='x').save()
+
+    def backend(self, policy, op='update:uid'):
+        params = slovar(backend='mongo', ns='dstest', name='col1', op=op, index_policy=policy)
+        return mongo_be.MONGOBackend(params, slovar())
+
+    def index_keys(self):
+        return [ix['key'][0][0] for ix in self.klass._get_collection().index_information().values()]
+
+    def test_warn(self):
+        with mock.patch.object(mongo_be.log.__class__, 'warning') as warning:
+            self.backend('warn').process_many([slovar(uid=1, name='y')])
+
+        assert 'every record scans ~1 documents' in str(warning.call_args_list)
+        assert 'uid' not in self.index_keys()
+
+    def test_refuse(self):
+        with pytest.raises(ValueError):
+            self.backend('refuse').process_many([slovar(uid=1, name='y')])
+
+        assert self.klass.objects(name='y').count() == 0
+        self.backend('refuse', op='update:id').preflight()
+
+    def test_create(self):
+        self.backend('create', op='delete:uid').process_many([slovar(uid=1)])
+        assert 'uid' in self.index_keys()
+        assert self.klass.objects.count() == 0
+
+        with mock.patch.object(mongo_be.MONGOBackend, 'create_op_index') as create:
+            self.backend('create').preflight()
+            assert not create.called
+
+    def test_bad_policy(self):
+        with pytest.raises(ValueError):
+            self.backend('sometimes')
+
+
+class TestReader(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.klass = datasets.get_dataset(self.ds('col1'))
+        self.klass._get_collection().insert_many([{'n': ix, 'even': not ix % 2} for ix in range(250)])
+
+    def read(self, **kw):
+        kw.setdefault('batch_size', 20)
+        return list(datasets.get_reader(self.ds('col1'), **kw))
+
+    def test_splits(self):
+        for split in ['auto', 'sample', 'minmax']:
+            chunks = self.read(split=split, workers=3, partitions=5)
+
+            assert max(len(it) for it in chunks) == 20
+            assert sorted(doc['n'] for chunk in chunks for doc in chunk) == list(range(250))
+
+    def test_numeric_ids(self):
+        collection = datasets.get_dataset(self.ds('col2'))._get_collection()
+        collection.insert_many([{'_id': ix} for ix in range(100)])
+
+        reader = datasets.get_reader(self.ds('col2'), split='minmax', partitions=4)
+        assert reader.split_points() == [24.75, 49.5, 74.25]
+        assert sorted(doc['_id'] for chunk in reader for doc in chunk) == list(range(100))
+
+    def test_query_fields(self):
+        docs = [doc for chunk in self.read(query={'even': True}, fields=['n']) for doc in chunk]
+
+        assert len(docs) == 125
+        assert set(docs[0]) == {'_id', 'n'}
+
+    def test_records(self):
+        reader = datasets.get_reader(self.ds('col1'), partitions=3)
+        records = list(reader.records())
+
+        assert len(records) == 250
+        assert isinstance(records[0], slovar) and 'id' in records[0]
+
+    def test_mixed_ids(self):
+        collection = self.klass._get_collection()
+        collection.insert_many([{'_id': 'uid-%s' % ix, 'n': 1000+ix} for ix in range(20)])
+        collection.insert_many([{'_id': ix, 'n': 2000+ix} for ix in range(10)])
+
+        for split in ['auto', 'sample']:
+            ns = sorted(doc['n'] for chunk in self.read(split=split, partitions=5) for doc in chunk)
+            assert ns == list(range(250)) + list(range(1000, 1020)) + list(range(2000, 2010))
+
+    def test_range_query(self):
+        reader = datasets.get_reader(self.ds('col1'), query={'even': True})
+
+        assert reader.range_query(None, None) == {'even': True}
+        assert reader.range_query(None, 5) == {'$and': [{'even': True}, {'_id': {'$not': {'$gte': 5}}}]}
+        assert reader.range_query(5, 10) == {'$and': [{'even': True}, {'_id': {'$gte': 5, '$lt': 10}}]}
+        assert reader.range_query(10, None) == {'$and': [{'even': True}, {'_id': {'$gte': 10}}]}
+
+    def test_stop_early(self):
+        reader = datasets.get_reader(self.ds('col1'), batch_size=10, workers=2, queue_size=1)
+
+        chunks = iter(reader)
+        assert len(next(chunks)) == 10
+        chunks.close()
+
+        assert not [it for it in threading.enumerate() if it.name.startswith('mongo-reader')]
+
+    def test_bad_split(self):
+        with pytest.raises(ValueError):
+            datasets.get_reader(self.ds('col1'), split='hash')
+
+
+class TestChangeSource(MongoTestCase):
+    namespaces = ['dstest', 'dstest2']
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.source = datasets.get_dataset(self.ds('src'))._get_collection()
+        self.target = slovar(backend='mongo', ns='dstest2', name='dst', skip_logs=True)
+
+    def insert(self, *names, updated_at=None):
+        updated_at = updated_at or datetime.utcnow()
+        self.source.insert_many([{'name': it, 'updated_at': updated_at} for it in names])
+
+    def change_source(self, **kw):
+        kw.setdefault('checkpoint', 'file:%s' % self.tmpdir)
+        kw.setdefault('job_id', 'src2dst')
+        kw.setdefault('mode', 'poll')
+        return mongo_be.ChangeSource(self.ds('src'), self.target, batch_size=2, poll_interval=0, **kw)
+
+    def copied(self):
+        return sorted(it.name for it in datasets.get_dataset(self.ds('dst', ns='dstest2')).objects)
+
+    def test_poll(self):
+        self.insert('a', 'b', 'c')
+
+        source = self.change_source()
+        with mock.patch.object(mongo_be.MONGOBackend, '__init__', autospec=True,
+                               side_effect=mongo_be.MONGOBackend.__init__) as init:
+            stats = source.run(until_idle=True)
+            # one target backend across batches
+            assert init.call_count == 1
+            assert list(source._backends) == ['upsert']
+
+        assert self.copied() == ['a', 'b', 'c']
+        assert stats.records == 3 and stats.batches == 2
+
+        # same instant as the last one polled, ordered by `_id`
+        self.insert('d', updated_at=self.source.find_one({'name': 'c'})['updated_at'])
+        self.insert('e')
+        self.source.update_one({'name': 'a'}, {'$set': {'name': 'A', 'updated_at': datetime.utcnow()}})
+
+        stats = self.change_source().run(until_idle=True)
+        assert stats.records == 3
+        assert self.copied() == ['A', 'b', 'c', 'd', 'e']
+
+    def test_fallback(self):
+        self.insert('a')
+        # what a standalone server answers
+        no_stream = mongo_be.OperationFailure('The $changeStream stage is only supported on replica sets', 40573)
+
+        source = self.change_source(mode='stream')
+        with mock.patch.object(source, 'collection') as collection:
+            collection.watch.side_effect = no_stream
+            with pytest.raises(mongo_be.OperationFailure):
+                source.run(until_idle=True)
+
+        source = self.change_source(mode='auto')
+        with mock.patch.object(source, 'run_stream', side_effect=no_stream):
+            assert source.run(until_idle=True).records == 1
+
+    def test_events(self):
+        _id = mongo_be.ObjectId()
+        events = [
+            {'operationType': 'insert', 'fullDocument': {'_id': _id, 'name': 'a'}},
+            {'operationType': 'update', 'fullDocument': {'_id': _id, 'name': 'b'}},
+            {'operationType': 'update', 'fullDocument': None},
+            {'operationType': 'delete', 'documentKey': {'_id': _id}},
+            {'operationType': 'drop'},
+        ]
+        source = self.change_source()
+        changes = [source.event_change(it) for it in events]
+
+        assert [it and it[0] for it in changes] == ['upsert', 'upsert', None, 'delete', None]
+        assert changes[3][1] == {'id': _id}
+
+        with mock.patch.object(source, 'apply_run') as apply_run:
+            source.apply(changes)
+        assert [it[0][0] for it in apply_run.call_args_list] == ['upsert', 'delete']
+
+    def test_replay(self):
+        _id = mongo_be.ObjectId()
+        event = {'operationType': 'insert', 'fullDocument': {'_id': _id, 'name': 'a'}}
+        source = self.change_source()
+
+        # a restart applies the last batch again
+        for _ in range(2):
+            source.apply([source.event_change(event)])
+
+        assert self.copied() == ['a']
+        assert source.stats.errors == 0
+
+    def test_bad_params(self):
+        with pytest.raises(ValueError):
+            self.change_source(mode='tail')
+        with pytest.raises(ValueError):
+            self.change_source(job_id=None)
+
+    def test_stream_needs_id_pk(self):
+        with pytest.raises(ValueError):
+            self.change_source(mode='stream', pk='uid')
+
+        assert self.change_source(mode='auto', pk='uid').mode == 'poll'
@@ -0,0 +1,59 @@
+import csv
+import io
+import mock
+import os
+import unittest
+
+import pytest
+from slovar import slovar
+
+moto = pytest.importorskip('moto')
+import boto3
+
+from datasets.backends.s3 import S3Backend, part_key
+
+
+class TestS3Flush(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        mock_aws = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+
+        patcher = mock_aws()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.bucket = boto3.resource('s3').create_bucket(Bucket='dstest')
+
+    def backend(self, **params):
+        params = slovar(params)
+        params.setdefault('name', 'out.csv')
+        params.setdefault('ns', 'dstest/exports')
+        params.setdefault('op', 'create')
+        params.setdefault('fields', ['id', 'value'])
+        params.setdefault('skip_logs', True)
+
+        with mock.patch('datasets.get_dataset'):
+            return S3Backend(params, slovar())
+
+    def read(self, key):
+        body = self.bucket.Object(key).get()['Body'].read().decode()
+        return list(csv.DictReader(io.StringIO(body)))
+
+    def test_part_key(self):
+        assert part_key('a/out.csv', 0) == 'a/out.csv'
+        assert part_key('a/out.csv', 2) == 'a/out.csv_part00002'
+
+    def test_chunks_in_parts(self):
+        be = self.backend(write_buffer_size=2, stream_flush=True)
+        assert be.flush_workers == 1
+
+        result = be.process_many(slovar(id=str(ix), value='x%s' % ix) for ix in range(5))
+        assert result.success == 5
+
+        keys = sorted(it.key for it in self.bucket.objects.all())
+        assert keys == ['exports/out.csv', 'exports/out.csv_part00001', 'exports/out.csv_part00002']
+
+        rows = [row for key in keys for row in self.read(key)]
+        assert [row['id'] for row in rows] == ['0', '1', '2', '3', '4']
+        assert rows[4]['value'] == 'x4'